@@ -18,21 +18,29 @@ from __future__ import with_statement
 
 __author__ = 'kbrisbin@google.com (Kathryn Hurley)'
 
+import array
+import hashlib
 import json
 import logging
 import os
 import time
 
 import lib_path
+import google_cloud.cs as cs
 import google_cloud.gce as gce
 import google_cloud.gce_appengine as gce_appengine
+import google_cloud.gce_exception as gce_exception
 import google_cloud.oauth as oauth
 import jinja2
 import oauth2client.appengine as oauth2client
 import user_data
 import webapp2
 
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.api import users
+from google.appengine.ext import deferred
 
 DEMO_NAME = 'fractal'
 CUSTOM_IMAGE = 'fractal-demo-image'
@@ -41,44 +49,449 @@ FIREWALL = 'www-fractal'
 FIREWALL_DESCRIPTION = 'Fractal Demo Firewall'
 GCE_SCOPE = 'https://www.googleapis.com/auth/compute'
 HEALTH_CHECK_TIMEOUT = 1
+# Bounds, in seconds, of the adaptive instance health check deadlines.
+HEALTH_CHECK_MIN_TIMEOUT = 0.2
+HEALTH_CHECK_MAX_TIMEOUT = 3
+# Consecutive failures after which an instance's circuit breaker opens, and
+# the bounds, in seconds, of how long it stays open.
+BREAKER_FAILURES = 3
+BREAKER_MIN_BACKOFF = 4
+BREAKER_MAX_BACKOFF = 60
+HEALTH_COLLECT_INTERVAL = 2
+HEALTH_SNAPSHOT_TTL = 10
+HEALTH_WATCH_TIMEOUT = 30
+# Windows, in seconds, over which tile rates and latencies are reported.
+RATE_WINDOWS = {'1m': 60, '5m': 300}
+SERIES_CAPACITY = max(RATE_WINDOWS.values()) / HEALTH_COLLECT_INTERVAL + 1
+LATENCY_PERCENTILES = (50, 90, 99)
 
 VM_FILES = os.path.join(os.path.dirname(__file__), 'vm_files')
 STARTUP_SCRIPT = os.path.join(VM_FILES, 'startup.sh')
 GO_PROGRAM = os.path.join(VM_FILES, 'mandelbrot.go')
+# The tile server compiled by vm_files/build.sh, if it was built.
+TILE_SERVER = os.path.join(VM_FILES, 'mandelbrot')
+TILE_SERVER_OBJECT = 'fractal-tile-server/%s'
+TILE_SERVER_CONTENT_TYPE = 'application/octet-stream'
+# The source published next to the tile server, for instances that can't
+# fetch or verify the binary to build it.
+TILE_SERVER_SOURCE_OBJECT = 'fractal-tile-server/%s.go'
+# Seconds the tile server is trusted to be in a bucket before it is checked
+# again.
+TILE_SERVER_CHECK_TTL = 600
 GO_ARGS = '--portBase=80 --numPorts=1'
 GO_TILESERVER_FLAG = '--tileServers='
 
+
+def _load_vm_files(file_names):
+  """Read files passed to the VMs through metadata.
+
+  Args:
+    file_names: A dictionary of metadata key -> path of the file to pass.
+
+  Returns:
+    A tuple with a dictionary of metadata key -> file contents and the
+    SHA-1 hex digest of all the contents.
+  """
+  contents = {}
+  digest = hashlib.sha1()
+  for key in sorted(file_names):
+    with open(file_names[key], 'r') as vm_file:
+      contents[key] = vm_file.read()
+    digest.update(key)
+    digest.update(contents[key])
+  return contents, digest.hexdigest()
+
+
+# The VM files only change with a new app version, so read them once.
+VM_FILE_VALUES, VM_FILES_HASH = _load_vm_files({
+  'startup-script': STARTUP_SCRIPT,
+  'goprog': GO_PROGRAM,
+})
+GO_PROGRAM_HASH = hashlib.sha1(VM_FILE_VALUES['goprog']).hexdigest()
+
+# The SHA-1 of the compiled tile server. The binary is streamed to Cloud
+# Storage when published rather than kept in memory.
+TILE_SERVER_HASH = None
+if os.path.exists(TILE_SERVER):
+  with open(TILE_SERVER, 'rb') as tile_server_file:
+    tile_server_digest = hashlib.sha1()
+    for block in iter(lambda: tile_server_file.read(cs.UPLOAD_CHUNK_SIZE), ''):
+      tile_server_digest.update(block)
+  TILE_SERVER_HASH = tile_server_digest.hexdigest()
+
 jinja_environment = jinja2.Environment(loader=jinja2.FileSystemLoader(''))
 oauth_decorator = oauth.decorator
 parameters = [
     user_data.DEFAULTS[user_data.GCE_PROJECT_ID],
     user_data.DEFAULTS[user_data.GCE_ZONE_NAME],
     user_data.DEFAULTS[user_data.GCE_LOAD_BALANCER_IP],
+    dict(user_data.DEFAULTS[user_data.GCS_BUCKET],
+         required=False,
+         label=('Cloud Storage Bucket Name for the compiled tile server '
+                '(optional)')),
 ]
 data_handler = user_data.DataHandler(DEMO_NAME, parameters)
 
 
+class TileSeries(object):
+  """A ring buffer of cluster-wide tile counters sampled over time.
+
+  Each sample holds, per tile size, the number of tiles rendered and the
+  time spent rendering them, summed over all servers. Servers restarting
+  reset their counters, so samples are built from the increase of each
+  server's counters since the previous sample rather than from the raw
+  counters. Samples are stored in fixed-size arrays.
+
+  Attributes:
+    capacity: The maximum number of samples kept.
+  """
+
+  def __init__(self, capacity=SERIES_CAPACITY):
+    """Constructor for TileSeries."""
+    self.capacity = capacity
+    self._timestamps = array.array('d', [0.0] * capacity)
+    # Maps of tile-size -> array of counter totals, one per sample.
+    self._counts = {}
+    self._times = {}
+    # Index of the next sample to write and number of samples stored.
+    self._head = 0
+    self._length = 0
+    # Maps of tile-size -> running counter totals.
+    self._count_totals = {}
+    self._time_totals = {}
+    # A map of server -> (timestamp, uptime, tileCount, tileTime) when the
+    # server was last seen.
+    self._last_vars = {}
+
+  def add(self, timestamp, server_vars):
+    """Record a sample.
+
+    Args:
+      timestamp: The time of the sample, in seconds since the epoch.
+      server_vars: A map of server name -> parsed JSON object returned from
+          its /debug/vars.
+    """
+    for name, instance_vars in server_vars.items():
+      last = self._last_vars.get(name)
+      counts = instance_vars['tileCount']
+      times = instance_vars['tileTime']
+      if last and not self._reset(last, instance_vars):
+        self._add_deltas(counts, last[2], self._count_totals)
+        self._add_deltas(times, last[3], self._time_totals)
+      elif last:
+        # The server restarted, so everything it counted is new.
+        self._add_deltas(counts, {}, self._count_totals)
+        self._add_deltas(times, {}, self._time_totals)
+      self._last_vars[name] = (
+          timestamp, instance_vars['uptime'], counts, times)
+
+    # Forget servers that have not been seen for longer than any window.
+    oldest = timestamp - max(RATE_WINDOWS.values())
+    for name, last in self._last_vars.items():
+      if last[0] < oldest:
+        del self._last_vars[name]
+
+    self._timestamps[self._head] = timestamp
+    for size, total in self._count_totals.items():
+      if size not in self._counts:
+        self._counts[size] = array.array('d', [0.0] * self.capacity)
+        self._times[size] = array.array('d', [0.0] * self.capacity)
+      self._counts[size][self._head] = total
+      self._times[size][self._head] = self._time_totals.get(size, 0)
+    self._head = (self._head + 1) % self.capacity
+    self._length = min(self._length + 1, self.capacity)
+
+  def get_window(self, seconds):
+    """Compute tile rates and latencies over a trailing window.
+
+    Args:
+      seconds: The length of the window.
+
+    Returns:
+      A map of tile-size -> {'tilesPerSec': rate, 'tileTimeAvgMs': latency},
+      computed between the newest sample and the oldest sample within the
+      window. Empty if there are fewer than two such samples.
+    """
+    if self._length < 2:
+      return {}
+    newest = (self._head - 1) % self.capacity
+    oldest = newest
+    for age in xrange(1, self._length):
+      index = (newest - age) % self.capacity
+      if self._timestamps[newest] - self._timestamps[index] > seconds:
+        break
+      oldest = index
+    elapsed = self._timestamps[newest] - self._timestamps[oldest]
+    if elapsed <= 0:
+      return {}
+
+    window = {}
+    for size, counts in self._counts.items():
+      count = counts[newest] - counts[oldest]
+      tile_time = self._times[size][newest] - self._times[size][oldest]
+      window[size] = {'tilesPerSec': count / elapsed}
+      if count:
+        # The raw time is in nanoseconds.
+        window[size]['tileTimeAvgMs'] = tile_time / count / (1000 * 1000)
+    return window
+
+  def _reset(self, last, instance_vars):
+    """Whether a server restarted since it was last seen."""
+    if instance_vars['uptime'] < last[1]:
+      return True
+    for size, count in last[2].items():
+      if long(instance_vars['tileCount'].get(size, 0)) < long(count):
+        return True
+    return False
+
+  def _add_deltas(self, src_map, last_map, dest_map):
+    """Add the increase of each counter in src_map to dest_map."""
+    for k, v in src_map.items():
+      dest_map[k] = dest_map.get(k, 0L) + long(v) - long(last_map.get(k, 0))
+
+
+class HealthProbes(object):
+  """Adaptive health check deadlines and circuit breakers for fractal VMs.
+
+  Each IP gets a deadline derived from its smoothed probe latency and the
+  variation of that latency, the way TCP computes retransmission timeouts.
+  After BREAKER_FAILURES consecutive failures the IP's circuit breaker
+  opens and it isn't probed again until the backoff expires. The backoff
+  doubles each time a probe in the half-open state fails. When the probe of
+  a borderline IP, one half-open or with recent failures or slow answers,
+  fails or misses its deadline, a hedged probe is sent with the rest of
+  HEALTH_CHECK_MAX_TIMEOUT before the IP is counted as failed.
+  """
+
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half-open'
+
+  def __init__(self):
+    """Constructor for HealthProbes."""
+    # A map of IP -> probe state dictionary.
+    self.states = {}
+
+  def get_deadline(self, ip, now):
+    """Return the deadline of the probe to send to an IP.
+
+    Args:
+      ip: The string IP of the instance.
+      now: The current time, in seconds since the epoch.
+
+    Returns:
+      The deadline in seconds, or None if the breaker is open.
+    """
+    state = self._get_state(ip)
+    if state['breaker'] == self.OPEN:
+      if now < state['openUntil']:
+        return None
+      state['breaker'] = self.HALF_OPEN
+    return self._get_deadline(state)
+
+  def get_hedge_deadline(self, ip, elapsed):
+    """Return the deadline of a hedged probe after the first one failed.
+
+    Args:
+      ip: The string IP of the instance.
+      elapsed: The seconds since the first probe was sent.
+
+    Returns:
+      The deadline in seconds, or None if the IP isn't borderline or too
+      little of HEALTH_CHECK_MAX_TIMEOUT is left.
+    """
+    state = self._get_state(ip)
+    borderline = (state['breaker'] == self.HALF_OPEN or
+                  state['failures'] > 0 or
+                  state['latency'] > 0.8 * self._get_deadline(state))
+    deadline = HEALTH_CHECK_MAX_TIMEOUT - elapsed
+    if not borderline or deadline < HEALTH_CHECK_MIN_TIMEOUT:
+      return None
+    return deadline
+
+  def record_success(self, ip, latency, now):
+    """Record a successful probe and its latency.
+
+    Args:
+      ip: The string IP of the instance.
+      latency: The probe latency, in seconds.
+      now: The current time, in seconds since the epoch.
+    """
+    state = self._get_state(ip)
+    if state['srtt'] is None:
+      state['srtt'] = latency
+      state['rttvar'] = latency / 2
+    else:
+      state['rttvar'] = (0.75 * state['rttvar'] +
+                         0.25 * abs(state['srtt'] - latency))
+      state['srtt'] = 0.875 * state['srtt'] + 0.125 * latency
+    state['latency'] = latency
+    state['failures'] = 0
+    state['backoff'] = 0
+    state['breaker'] = self.CLOSED
+    state['lastSuccess'] = now
+
+  def record_failure(self, ip, now):
+    """Record a failed probe, opening the breaker if needed.
+
+    Args:
+      ip: The string IP of the instance.
+      now: The current time, in seconds since the epoch.
+    """
+    state = self._get_state(ip)
+    state['failures'] += 1
+    if (state['breaker'] == self.HALF_OPEN or
+        state['failures'] >= BREAKER_FAILURES):
+      state['backoff'] = min(max(state['backoff'] * 2, BREAKER_MIN_BACKOFF),
+                             BREAKER_MAX_BACKOFF)
+      state['breaker'] = self.OPEN
+      state['openUntil'] = now + state['backoff']
+
+  def get_report(self, ip, now):
+    """Return the probe state of an IP, for the instance response.
+
+    Args:
+      ip: The string IP of the instance.
+      now: The current time, in seconds since the epoch.
+
+    Returns:
+      A dictionary with the breaker state, the number of consecutive
+      failures, the next deadline and the age, in seconds, of the last
+      successful probe (None if there was none).
+    """
+    state = self._get_state(ip)
+    age = None
+    if state['lastSuccess'] is not None:
+      age = now - state['lastSuccess']
+    return {
+      'breaker': state['breaker'],
+      'failures': state['failures'],
+      'deadlineSec': self._get_deadline(state),
+      'ageSec': age,
+    }
+
+  def forget_others(self, ips):
+    """Drop the state of IPs other than the given ones."""
+    for ip in self.states.keys():
+      if ip not in ips:
+        del self.states[ip]
+
+  def _get_state(self, ip):
+    """Return the probe state of an IP, creating it if needed."""
+    if ip not in self.states:
+      self.states[ip] = {
+        'breaker': self.CLOSED,
+        'failures': 0,
+        'backoff': 0,
+        'openUntil': 0,
+        'srtt': None,
+        'rttvar': None,
+        'latency': 0,
+        'lastSuccess': None,
+      }
+    return self.states[ip]
+
+  def _get_deadline(self, state):
+    """Return the deadline for a probe given the observed latencies."""
+    if state['srtt'] is None:
+      return HEALTH_CHECK_TIMEOUT
+    deadline = state['srtt'] + 4 * state['rttvar']
+    return min(max(deadline, HEALTH_CHECK_MIN_TIMEOUT),
+               HEALTH_CHECK_MAX_TIMEOUT)
+
+
+def tile_latency_percentiles(tile_latency):
+  """Estimate latency percentiles for each tile size.
+
+  Args:
+    tile_latency: A map of tile-size -> tileLatency histogram.
+
+  Returns:
+    A map of tile-size -> map of percentile name -> latency in milliseconds.
+  """
+  return dict((size, latency_percentiles(histogram))
+              for size, histogram in tile_latency.items())
+
+
+def latency_percentiles(histogram):
+  """Estimate latency percentiles from a tileLatency histogram.
+
+  Each percentile is interpolated linearly within the bucket holding it.
+  Percentiles falling in the "inf" bucket are reported as the last finite
+  bound.
+
+  Args:
+    histogram: A map of bucket upper bound in milliseconds (or "inf") ->
+        request count, as published in /debug/vars tileLatency.
+
+  Returns:
+    A map of 'p50', 'p90' and 'p99' -> latency in milliseconds. Empty if the
+    histogram holds no requests.
+  """
+  keys = sorted((key for key in histogram if key != 'inf'), key=float)
+  bounds = [float(key) for key in keys]
+  counts = [long(histogram[key]) for key in keys]
+  counts.append(long(histogram.get('inf', 0)))
+  total = sum(counts)
+  if not total:
+    return {}
+
+  percentiles = {}
+  for percentile in LATENCY_PERCENTILES:
+    rank = total * percentile / 100.0
+    seen = 0
+    lower = 0.0
+    for i, count in enumerate(counts):
+      if i == len(bounds):
+        percentiles['p%d' % percentile] = lower
+        break
+      if count and seen + count >= rank:
+        fraction = (rank - seen) / count
+        percentiles['p%d' % percentile] = lower + fraction * (bounds[i] - lower)
+        break
+      seen += count
+      lower = bounds[i]
+  return percentiles
+
+
 class ServerVarsAggregator(object):
   """Aggregate stats across multiple servers and produce a summary."""
 
-  def __init__(self):
-    """Constructor for ServerVarsAggregator."""
+  def __init__(self, series=None):
+    """Constructor for ServerVarsAggregator.
+
+    Args:
+      series: An optional TileSeries to which the aggregated vars are added
+          as a sample, used to report rates over RATE_WINDOWS.
+    """
     # A map of tile-size -> count
     self.tile_counts = {}
     # A map of tile-size -> time
     self.tile_times = {}
+    # A map of tile-size -> latency bucket -> count
+    self.tile_latency = {}
 
     # The uptime of the server that has been up and running the longest.
     self.max_uptime = 0
 
-  def aggregate_vars(self, instance_vars):
+    self.series = series
+    # A map of server name -> vars, for the series.
+    self.server_vars = {}
+
+  def aggregate_vars(self, instance_vars, name=None):
     """Integrate instance_vars into the running aggregates.
 
     Args:
       instance_vars A parsed JSON object returned from /debug/vars
+      name: The name of the server, required to add it to the series.
     """
+    if name:
+      self.server_vars[name] = instance_vars
     self._aggregate_map(instance_vars['tileCount'], self.tile_counts)
     self._aggregate_map(instance_vars['tileTime'], self.tile_times)
+    # Servers without latency histograms are left out of them.
+    for size, histogram in instance_vars.get('tileLatency', {}).items():
+      self._aggregate_map(histogram, self.tile_latency.setdefault(size, {}))
     self.max_uptime = max(self.max_uptime, instance_vars['uptime'])
 
   def _aggregate_map(self, src_map, dest_map):
@@ -93,92 +506,183 @@ class ServerVarsAggregator(object):
       'tileCount': self.tile_counts.copy(),
       'tileTime': self.tile_times.copy(),
       'tileTimeAvgMs': tile_time_avg,
+      'tileLatency': self.tile_latency,
+      'tileLatencyPercentilesMs': tile_latency_percentiles(self.tile_latency),
       'maxUptime': self.max_uptime,
     }
     for size, count in self.tile_counts.items():
-      time = self.tile_times.get(size, 0)
-      if time and count:
+      tile_time = self.tile_times.get(size, 0)
+      if tile_time and count:
         # Compute average tile time in milliseconds.  The raw time is in
         # nanoseconds.
-        tile_time_avg[size] = float(time / count) / float(1000*1000)
-        logging.debug('tile-size: %s count: %d time: %d avg: %d', size, count, time, tile_time_avg[size])
+        tile_time_avg[size] = float(tile_time / count) / float(1000*1000)
+        logging.debug('tile-size: %s count: %d time: %d avg: %d', size, count, tile_time, tile_time_avg[size])
+    if self.series:
+      self.series.add(time.time(), self.server_vars)
+      result['windows'] = {}
+      for window, seconds in RATE_WINDOWS.items():
+        result['windows'][window] = self.series.get_window(seconds)
     return result
 
 
-class Fractal(webapp2.RequestHandler):
-  """Fractal demo."""
+class ClusterHealth(object):
+  """Collects and caches the health of a fractal cluster.
+
+  Health checking a cluster fans out an RPC to every VM and load balancer.
+  Rather than doing that on every browser poll, a chain of deferred tasks
+  collects the cluster's health once per HEALTH_COLLECT_INTERVAL and stores
+  the result in memcache, for as long as someone is polling it.
+
+  Attributes:
+    prefix: The string prefix of the cluster's instance names.
+  """
+
+  def __init__(self, project_id, zone_name, prefix):
+    """Initializes the ClusterHealth class.
+
+    Args:
+      project_id: The string name of the Compute Engine project.
+      zone_name: The string name of the zone.
+      prefix: The string prefix of the cluster's instance names.
+    """
+
+    self.project_id = project_id
+    self.zone_name = zone_name
+    self.prefix = prefix
+    self._key = 'fractal-health:%s:%s:%s' % (project_id, zone_name, prefix)
+    self._watched_key = self._key + ':watched'
+    self._series_key = self._key + ':series'
+    self._probes_key = self._key + ':probes'
+    self._collector_key = self._key + ':collector'
 
-  @oauth_decorator.oauth_required
-  @data_handler.data_required
   def get(self):
-    """Show main page of Fractal demo."""
+    """Returns the last collected health, or None."""
 
-    template = jinja_environment.get_template(
-        'demos/%s/templates/index.html' % DEMO_NAME)
-    data = data_handler.stored_user_data
-    gce_project_id = data[user_data.GCE_PROJECT_ID]
-    gce_load_balancer_ip = self._get_lb_servers()
-    self.response.out.write(template.render({
-      'demo_name': DEMO_NAME,
-      'lb_enabled': bool(gce_load_balancer_ip),
-      'lb_ip': ', '.join(gce_load_balancer_ip),
-    }))
+    return memcache.get(self._key)
 
-  @oauth_decorator.oauth_required
-  @data_handler.data_required
-  def get_instances(self):
-    """List instances.
+  def invalidate(self):
+    """Drops the last collected health."""
 
-    Uses app engine app identity to retrieve an access token for the app
-    engine service account. No client OAuth required. External IP is used
-    to determine if the instance is actually running.
+    memcache.delete(self._key)
+
+  def schedule(self, user_id, loadbalancers):
+    """Marks the cluster as watched and starts the collector if needed.
+
+    Args:
+      user_id: The string id of the user owning the cluster.
+      loadbalancers: A list of the string load balancer IPs.
+    """
+
+    memcache.set(self._watched_key, time.time())
+    if memcache.add(self._collector_key, True, time=HEALTH_WATCH_TIMEOUT):
+      self._defer(user_id, loadbalancers)
+
+  def run_collector(self, user_id, loadbalancers):
+    """Collects the cluster's health and schedules the next run.
+
+    The chain of tasks stops once nobody has polled the cluster for
+    HEALTH_WATCH_TIMEOUT seconds.
+
+    Args:
+      user_id: The string id of the user owning the cluster.
+      loadbalancers: A list of the string load balancer IPs.
+
+    Raises:
+      PermanentTaskFailure: Raised when the user has no valid credentials.
+    """
+
+    watched = memcache.get(self._watched_key)
+    if not watched or time.time() - watched > HEALTH_WATCH_TIMEOUT:
+      memcache.delete(self._collector_key)
+      return
+
+    credentials = oauth2client.StorageByKeyName(
+        oauth2client.CredentialsModel, user_id, 'credentials').get()
+    if not credentials or credentials.invalid:
+      # A later poll restarts the collector, once the user authorized again.
+      memcache.delete(self._collector_key)
+      raise deferred.PermanentTaskFailure(
+          'No valid credentials for user %s.' % user_id)
+    try:
+      with gce.project_pool.project(
+          credentials, user_id, project_id=self.project_id,
+          zone_name=self.zone_name) as gce_project:
+        self.collect(gce_project, loadbalancers, save_state=True)
+    except (gce_exception.GceError, gce_exception.GceTokenError), e:
+      logging.error('Error collecting health of %s: %s', self.prefix, e)
+
+    memcache.set(self._collector_key, True, time=HEALTH_WATCH_TIMEOUT)
+    self._defer(user_id, loadbalancers)
+
+  def _defer(self, user_id, loadbalancers):
+    """Schedules the next collector run."""
+
+    deferred.defer(collect_cluster_health, user_id, self.project_id,
+                   self.zone_name, self.prefix, loadbalancers,
+                   _countdown=HEALTH_COLLECT_INTERVAL)
+
+  def _probe(self, ip, deadline):
+    """Starts a health check RPC to an instance's /debug/vars."""
+
+    health_url = 'http://%s/debug/vars?t=%d' % (ip, int(time.time()))
+    logging.debug('Health checking %s, deadline %.2fs', health_url, deadline)
+    rpc = urlfetch.create_rpc(deadline=deadline)
+    urlfetch.make_fetch_call(rpc, url=health_url)
+    return rpc
+
+  def collect(self, gce_project, loadbalancers, save_state=False):
+    """Health checks the cluster and caches the result.
+
+    The tile series and probe state are read-modify-written without locking,
+    so only the collector saves them. Other callers use them to build the
+    result, then drop their changes.
+
+    Args:
+      gce_project: An instance of gce.GceProject.
+      loadbalancers: A list of the string load balancer IPs.
+      save_state: True to save the updated tile series and probe state.
+
+    Returns:
+      A dictionary with the instances, their aggregated vars and the load
+      balancer health.
+
+    Raises:
+      GceError: Raised when listing the instances fails.
+      GceTokenError: Raised when the access token fails to refresh.
     """
 
-    gce_project = self._create_gce()
-    instances = gce_appengine.GceAppEngine().run_gce_request(
-        self,
-        gce_project.list_instances,
-        'Error listing instances: ',
-        filter='name eq ^%s-.*' % self.instance_prefix())
+    inventory = gce_appengine.InstanceInventory(gce_project, self.prefix)
+    instance_dict = inventory.get()
+    if instance_dict is None:
+      instance_dict = inventory.refresh(gce_project.list_instances(
+          filter=gce_appengine.cluster_filter(self.prefix),
+          projection=gce_appengine.INVENTORY_FIELDS))
 
-    # A map of instanceName -> (ip, RPC)
+    # A map of RPC -> (instanceName, start time, whether it is a hedge).
     health_rpcs = {}
+    probes = memcache.get(self._probes_key) or HealthProbes()
 
-    # Convert instance info to dict and check server status.
+    # Check server status.
     num_running = 0
-    instance_dict = {}
-    if instances:
-      for instance in instances:
-        instance_record = {}
-        instance_dict[instance.name] = instance_record
-        if instance.status:
-          instance_record['status'] = instance.status
-        else:
-          instance_record['status'] = 'OTHER'
-        ip = None
-        for interface in instance.network_interfaces:
-          for config in interface.get('accessConfigs', []):
-            if 'natIP' in config:
-              ip = config['natIP']
-              instance_record['externalIp'] = ip
-              break
-          if ip: break
-
-        # Ping the instance server. Grab stats from /debug/vars.
-        if ip and instance.status == 'RUNNING':
-          num_running += 1
-          health_url = 'http://%s/debug/vars?t=%d' % (ip, int(time.time()))
-          logging.debug('Health checking %s', health_url)
-          rpc = urlfetch.create_rpc(deadline = HEALTH_CHECK_TIMEOUT)
-          urlfetch.make_fetch_call(rpc, url=health_url)
-          health_rpcs[instance.name] = rpc
+    running_ips = set()
+    now = time.time()
+    for instance_name, instance_record in instance_dict.items():
+      ip = instance_record.get('externalIp')
+
+      # Ping the instance server. Grab stats from /debug/vars.
+      if ip and instance_record['status'] == 'RUNNING':
+        num_running += 1
+        running_ips.add(ip)
+        deadline = probes.get_deadline(ip, now)
+        if deadline is not None:
+          rpc = self._probe(ip, deadline)
+          health_rpcs[rpc] = (instance_name, time.time(), False)
 
     # Ping through a LBs too.  Only if we get success there do we know we are
     # really serving.
-    loadbalancers = []
+    if len(instance_dict) < 2:
+      loadbalancers = []
     lb_rpcs = {}
-    if instances and len(instances) > 1:
-      loadbalancers = self._get_lb_servers()
     if num_running > 0 and loadbalancers:
       for lb in loadbalancers:
         health_url = 'http://%s/health?t=%d' % (lb, int(time.time()))
@@ -188,28 +692,59 @@ class Fractal(webapp2.RequestHandler):
         lb_rpcs[lb] = rpc
 
     # wait for RPCs to complete and update dict as necessary
-    vars_aggregator = ServerVarsAggregator()
-
-    # TODO: there is significant duplication here.  Refactor.
-    for (instance_name, rpc) in health_rpcs.items():
-      result = None
+    series = memcache.get(self._series_key) or TileSeries()
+    vars_aggregator = ServerVarsAggregator(series)
+
+    # Handle instance RPCs in the order they complete, so the observed
+    # latency of each is accurate. Hedged probes are added as first probes
+    # of borderline instances fail.
+    pending = health_rpcs.keys()
+    while pending:
+      rpc = apiproxy_stub_map.UserRPC.wait_any(pending)
+      pending.remove(rpc)
+      instance_name, started, hedged = health_rpcs[rpc]
       instance_record = instance_dict[instance_name]
+      ip = instance_record['externalIp']
+      latency = time.time() - started
       try:
         result = rpc.get_result()
         if result and "memstats" in result.content:
           logging.debug('%s healthy!', instance_name)
           instance_record['status'] = 'SERVING'
+          probes.record_success(ip, latency, time.time())
           instance_vars = {}
           try:
             instance_vars = json.loads(result.content)
             instance_record['vars'] = instance_vars
-            vars_aggregator.aggregate_vars(instance_vars)
+            instance_record['tileLatencyPercentilesMs'] = (
+                tile_latency_percentiles(instance_vars.get('tileLatency', {})))
+            vars_aggregator.aggregate_vars(instance_vars, instance_name)
           except ValueError as error:
             logging.error('Error decoding vars json for %s: %s', instance_name, error)
+          continue
         else:
           logging.debug('%s unhealthy. Content: %s', instance_name, result.content)
       except urlfetch.Error as error:
         logging.debug('%s unhealthy: %s', instance_name, str(error))
+      if not hedged:
+        deadline = probes.get_hedge_deadline(ip, latency)
+        if deadline is not None:
+          hedge_rpc = self._probe(ip, deadline)
+          health_rpcs[hedge_rpc] = (instance_name, time.time(), True)
+          pending.append(hedge_rpc)
+          continue
+      probes.record_failure(ip, time.time())
+
+    # Report each running instance's probe state, including the ones whose
+    # circuit breaker is open and so were not checked.
+    now = time.time()
+    probes.forget_others(running_ips)
+    for instance_record in instance_dict.values():
+      ip = instance_record.get('externalIp')
+      if ip in running_ips:
+        instance_record['health'] = probes.get_report(ip, now)
+    if save_state:
+      memcache.set(self._probes_key, probes, time=HEALTH_WATCH_TIMEOUT)
 
     # Check health status through the load balancer.
     loadbalancer_healthy = bool(lb_rpcs)
@@ -229,102 +764,133 @@ class Fractal(webapp2.RequestHandler):
         break
 
     response_dict = {
+      'collected': time.time(),
       'instances': instance_dict,
       'vars': vars_aggregator.get_aggregate(),
       'loadbalancers': loadbalancers,
       'loadbalancer_healthy': loadbalancer_healthy,
     }
-    self.response.headers['Content-Type'] = 'application/json'
-    self.response.out.write(json.dumps(response_dict))
-
-  @oauth_decorator.oauth_required
-  @data_handler.data_required
-  def set_instances(self):
-    """Start/stop instances so we have the requested number running."""
-
-    gce_project = self._create_gce()
-
-    self._setup_firewall(gce_project)
-    image = self._get_image(gce_project)
-    disks = self._get_disks(gce_project)
-
-    # Get the list of instances to insert.
-    num_instances = int(self.request.get('num_instances'))
-    target = self._get_instance_list(
-        gce_project, num_instances, image, disks)
-    target_set = set()
-    target_map = {}
-    for instance in target:
-      target_set.add(instance.name)
-      target_map[instance.name] = instance
-
-    # Get the list of instances running
-    current = gce_appengine.GceAppEngine().run_gce_request(
-        self,
-        gce_project.list_instances,
-        'Error listing instances: ',
-        filter='name eq ^%s-.*' % self.instance_prefix())
-    current_set = set()
-    current_map = {}
-    for instance in current:
-      current_set.add(instance.name)
-      current_map[instance.name] = instance
-
-    # Add the new instances
-    to_add_set = target_set - current_set
-    to_add = [target_map[name] for name in to_add_set]
-    if to_add:
-      gce_appengine.GceAppEngine().run_gce_request(
-          self,
-          gce_project.bulk_insert,
-          'Error inserting instances: ',
-          resources=to_add)
-
-    # Remove the old instances
-    to_remove_set = current_set - target_set
-    to_remove = [current_map[name] for name in to_remove_set]
-    if to_remove:
-      gce_appengine.GceAppEngine().run_gce_request(
-          self,
-          gce_project.bulk_delete,
-          'Error deleting instances: ',
-          resources=to_remove)
-
-    logging.info("current_set: %s", current_set)
-    logging.info("target_set: %s", target_set)
-    logging.info("to_add_set: %s", to_add_set)
-    logging.info("to_remove_set: %s", to_remove_set)
-
-  @oauth_decorator.oauth_required
-  @data_handler.data_required
-  def cleanup(self):
-    """Stop instances using the gce_appengine helper class."""
-    gce_project = self._create_gce()
-    gce_appengine.GceAppEngine().delete_demo_instances(
-        self, gce_project, self.instance_prefix())
-
-  def _get_lb_servers(self):
-    data = data_handler.stored_user_data
-    return data.get(user_data.GCE_LOAD_BALANCER_IP, [])
-
-  def instance_prefix(self):
-    """Return a prefix based on a request/query params."""
-    tag = self.request.get('tag')
-    prefix = DEMO_NAME
-    if tag:
-      prefix = prefix + '-' + tag
-    return prefix
-
-  def _create_gce(self):
-    gce_project_id = data_handler.stored_user_data[user_data.GCE_PROJECT_ID]
-    gce_zone_name = data_handler.stored_user_data[user_data.GCE_ZONE_NAME]
-    return gce.GceProject(oauth_decorator.credentials,
-                          project_id=gce_project_id,
-                          zone_name=gce_zone_name)
+    memcache.set(self._key, response_dict, time=HEALTH_SNAPSHOT_TTL)
+    if save_state:
+      memcache.set(self._series_key, series, time=max(RATE_WINDOWS.values()))
+    return response_dict
+
+
+def collect_cluster_health(user_id, project_id, zone_name, prefix,
+                           loadbalancers):
+  """Deferred task collecting a cluster's health while it is watched.
+
+  Args:
+    user_id: The string id of the user owning the cluster.
+    project_id: The string name of the Compute Engine project.
+    zone_name: The string name of the zone.
+    prefix: The string prefix of the cluster's instance names.
+    loadbalancers: A list of the string load balancer IPs.
+  """
+
+  ClusterHealth(project_id, zone_name, prefix).run_collector(
+      user_id, loadbalancers)
+
+
+def publish_tile_server(credentials, project_id, bucket):
+  """Upload the compiled tile server and its source to Cloud Storage.
+
+  The objects are named after their SHA-1, so they only have to be uploaded
+  once per bucket and build. Whether they are still in the bucket is checked
+  again every TILE_SERVER_CHECK_TTL seconds, in case they were deleted.
+
+  Args:
+    credentials: An oauth2client.client.Credentials object.
+    project_id: The string Cloud Storage project ID.
+    bucket: The string name of the bucket to upload to.
+
+  Returns:
+    A dictionary of the instance metadata with the gs:// URLs and SHA-1s of
+    the tile server and its source, or None if it wasn't built.
+
+  Raises:
+    CsError: Raised when an upload fails.
+  """
+  if not TILE_SERVER_HASH:
+    return None
+  gcs = cs.Cs(project_id)
+  server_name = TILE_SERVER_OBJECT % TILE_SERVER_HASH
+  source_name = TILE_SERVER_SOURCE_OBJECT % GO_PROGRAM_HASH
+
+  def upload_server():
+    with open(TILE_SERVER, 'rb') as tile_server_file:
+      gcs.upload_resumable(
+          credentials.access_token, bucket, server_name, tile_server_file,
+          content_type=TILE_SERVER_CONTENT_TYPE)
+
+  def upload_source():
+    gcs.upload(credentials.access_token, bucket, source_name,
+               VM_FILE_VALUES['goprog'])
+
+  _publish_object(gcs, credentials.access_token, bucket, server_name,
+                  upload_server)
+  _publish_object(gcs, credentials.access_token, bucket, source_name,
+                  upload_source)
+  return {
+    'tile-server-url': 'gs://%s/%s' % (bucket, server_name),
+    'tile-server-sha1': TILE_SERVER_HASH,
+    'goprog-url': 'gs://%s/%s' % (bucket, source_name),
+    'goprog-sha1': GO_PROGRAM_HASH,
+  }
+
+
+def _publish_object(gcs, oauth_token, bucket, object_name, upload):
+  """Call upload unless the object was recently seen in the bucket.
+
+  Args:
+    gcs: An instance of cs.Cs.
+    oauth_token: String oauth token for sending authorized requests.
+    bucket: The string name of the bucket.
+    object_name: The string name of the object.
+    upload: A function uploading the object.
+  """
+  published_key = 'fractal-tile-server:%s/%s' % (bucket, object_name)
+  if memcache.get(published_key):
+    return
+  if not gcs.exists(oauth_token, bucket, object_name):
+    logging.info('Publishing %s/%s', bucket, object_name)
+    upload()
+  memcache.set(published_key, True, time=TILE_SERVER_CHECK_TTL)
+
+
+class FractalSpec(gce_appengine.ClusterSpec):
+  """Describes the instances of a fractal cluster.
+
+  The objective's parameters hold the load balancer IPs and the bucket the
+  compiled tile server is published to.
+  """
+
+  def get_queries(self, objective):
+    """Return the firewall, custom image and boot disk listings."""
+    return {
+      'firewalls': (gce.Firewall, {'projection': ('name',)}),
+      'images': (gce.Image, {
+        'filter': 'name eq ^%s$' % CUSTOM_IMAGE,
+        'projection': ('name',),
+      }),
+      'disks': (gce.Disk, {
+        'filter': 'name eq ^boot-%s-.*' % objective.prefix,
+        'projection': ('name', 'zone'),
+      }),
+    }
 
-  def _setup_firewall(self, gce_project):
-    "Create the firewall if it doesn't exist."
-    firewalls = gce_project.list_firewalls()
+  def build_instances(self, gce_project, objective, listings):
+    """Return the cluster's instances, creating the firewall if needed."""
+    self._setup_firewall(gce_project, listings['firewalls'])
+    image = self._get_image(gce_project, listings['images'])
+    disks = self._get_disks(listings['disks'])
+    tile_server = self._publish_tile_server(
+        gce_project, (objective.parameters or {}).get('bucket'))
+    return self._get_instance_list(
+        gce_project, objective, image, disks, tile_server)
+
+  def _setup_firewall(self, gce_project, firewalls):
+    "Create the firewall if it isn't in the listed firewalls."
     firewall_names = [firewall.name for firewall in firewalls]
     if not FIREWALL in firewall_names:
       firewall = gce.Firewall(
@@ -333,46 +899,76 @@ class Fractal(webapp2.RequestHandler):
           description=FIREWALL_DESCRIPTION)
       gce_project.insert(firewall)
 
-  def _get_image(self, gce_project):
-    """Returns the appropriate image to use.  def _has_custom_image(self, gce_project):
+  def _get_image(self, gce_project, images):
+    """Returns the appropriate image to use.
 
     Args:
       gce_project: An instance of gce.GceProject
+      images: A list of the listed custom images.
 
     Returns: (project, image_name) for the image to use.
     """
-    images = gce_project.list_images(filter='name eq ^%s$' % CUSTOM_IMAGE)
     if images:
       return (gce_project.project_id, CUSTOM_IMAGE)
     return ('google', None)
 
-  def _get_disks(self, gce_project):
-    """Get boot disks for VMs."""
-    disks_array = gce_project.list_disks(
-      filter='name eq ^boot-%s-.*' % self.instance_prefix())
-
+  def _get_disks(self, disks_array):
+    """Get boot disks for VMs from the listed disks."""
     disks = {}
     for d in disks_array:
       disks[d.name] = d
     return disks
 
-  def _get_instance_metadata(self, gce_project, instance_names):
-    """The metadata values to pass into the instance."""
+  def _publish_tile_server(self, gce_project, bucket):
+    """Publish the compiled tile server to the user's bucket, if any.
+
+    Args:
+      gce_project: An instance of gce.GceProject.
+      bucket: The string name of the user's bucket, or None.
+
+    Returns:
+      A dictionary of the metadata locating the tile server and its source,
+      or None if the instances should build it from the inlined source.
+    """
+    if not bucket:
+      return None
+    try:
+      return publish_tile_server(
+          gce_project.credentials, gce_project.project_id, bucket)
+    except (cs.CsError, urlfetch.Error) as e:
+      logging.error('Error publishing the tile server: %s', e)
+      return None
+
+  def _get_instance_metadata(self, gce_project, instance_names,
+                             loadbalancers, tile_server=None):
+    """The metadata values to pass into the instances.
+
+    The list is shared by all the instances of a scale operation, so it
+    shouldn't be modified.
+
+    Args:
+      gce_project: An instance of gce.GceProject.
+      instance_names: A list of the string instance names.
+      loadbalancers: A list of the string load balancer IPs.
+      tile_server: A dictionary of the metadata locating the compiled tile
+          server and its source, or None to inline the source instead.
+
+    Returns:
+      A list of metadata items.
+    """
     inline_values = {
       'goargs': GO_ARGS,
+      'vm-files-hash': VM_FILES_HASH,
     }
-
-    file_values = {
-      'startup-script': STARTUP_SCRIPT,
-      'goprog': GO_PROGRAM,
-    }
+    if tile_server:
+      inline_values.update(tile_server)
 
     # Try and use LBs if we have any.  But only do that if we have more than one
     # instance.
     if instance_names:
       tile_servers = ''
       if len(instance_names) > 1:
-        tile_servers = self._get_lb_servers()
+        tile_servers = loadbalancers
       if not tile_servers:
         tile_servers = instance_names
       tile_servers = ','.join(tile_servers)
@@ -382,61 +978,186 @@ class Fractal(webapp2.RequestHandler):
     for k, v in inline_values.items():
       metadata.append({'key': k, 'value': v})
 
-    for k, fv in file_values.items():
-      v = open(fv, 'r').read()
+    for k, v in VM_FILE_VALUES.items():
+      # The source is only inlined when instances can't fetch it.
+      if k == 'goprog' and tile_server:
+        continue
       metadata.append({'key': k, 'value': v})
     return metadata
 
-  def _get_instance_list(self, gce_project, num_instances, image, disks):
+  def _get_instance_list(self, gce_project, objective, image, disks,
+                         tile_server=None):
     """Get a list of instances to start.
 
     Args:
       gce_project: An instance of gce.GceProject.
-      num_instances: The number of instances to start.
+      objective: The gce_appengine.ClusterObjective of the cluster.
       image: tuple with (project_name, image_name) for the image to use.
       disks: A dictionary of disk_name -> disk resources
+      tile_server: A dictionary of the metadata locating the compiled tile
+          server and its source, or None to have the instances build it.
 
     Returns:
-      A list of gce.Instances.
+      A list of gce.TemplateInstances.
     """
 
-
     instance_names = []
-    for i in range(num_instances):
-      instance_names.append('%s-%02d' % (self.instance_prefix(), i))
+    for i in range(objective.target_instances):
+      instance_names.append('%s-%02d' % (objective.prefix, i))
+
+    # Instances with a boot disk boot from it, the others from the image.
+    # Either way all their shared fields are resolved once.
+    parameters = objective.parameters or {}
+    metadata = self._get_instance_metadata(
+        gce_project, instance_names, parameters.get('loadbalancers', []),
+        tile_server)
+    image_project_id, image_name = image
+    shared = {
+      'machine_type_name': MACHINE_TYPE,
+      'zone_name': objective.zone_name,
+      'tags': [DEMO_NAME, objective.prefix],
+      'metadata': metadata,
+      'service_accounts': gce_project.settings['cloud_service_account'],
+    }
+    image_template = gce.InstanceTemplate(
+        image_name=image_name, image_project_id=image_project_id, **shared)
+    disk_template = gce.InstanceTemplate(
+        kernel=gce_project.settings['compute']['kernel'], **shared)
 
     instance_list = []
     for instance_name in instance_names:
       disk_name = 'boot-%s' % instance_name
       disk = disks.get(disk_name, None)
-      disk_mounts = []
-      image_project_id = None
-      image_name = None
-      kernel = None
       if disk:
         dm = gce.DiskMount(disk=disk, boot=True)
-        kernel = gce_project.settings['compute']['kernel']
-        disk_mounts.append(dm)
+        instance = disk_template.stamp(instance_name, disk_mounts=[dm])
       else:
-        image_project_id, image_name = image
-
-
-      gce_zone_name = data_handler.stored_user_data[user_data.GCE_ZONE_NAME]
-      instance = gce.Instance(
-          name=instance_name,
-          machine_type_name=MACHINE_TYPE,
-          zone_name=gce_zone_name,
-          image_name=image_name,
-          image_project_id=image_project_id,
-          disk_mounts=disk_mounts,
-          kernel=kernel,
-          tags=[DEMO_NAME, self.instance_prefix()],
-          metadata=self._get_instance_metadata(gce_project, instance_names),
-          service_accounts=gce_project.settings['cloud_service_account'])
+        instance = image_template.stamp(instance_name)
       instance_list.append(instance)
     return instance_list
 
 
+class Fractal(webapp2.RequestHandler):
+  """Fractal demo."""
+
+  @oauth_decorator.oauth_required
+  @data_handler.data_required
+  def get(self):
+    """Show main page of Fractal demo."""
+
+    template = jinja_environment.get_template(
+        'demos/%s/templates/index.html' % DEMO_NAME)
+    data = data_handler.stored_user_data
+    gce_project_id = data[user_data.GCE_PROJECT_ID]
+    gce_load_balancer_ip = self._get_lb_servers()
+    self.response.out.write(template.render({
+      'demo_name': DEMO_NAME,
+      'lb_enabled': bool(gce_load_balancer_ip),
+      'lb_ip': ', '.join(gce_load_balancer_ip),
+    }))
+
+  @oauth_decorator.oauth_required
+  @data_handler.data_required
+  def get_instances(self):
+    """List instances.
+
+    Uses app engine app identity to retrieve an access token for the app
+    engine service account. No client OAuth required. External IP is used
+    to determine if the instance is actually running. The health collected
+    in the background by ClusterHealth is returned when available.
+    """
+
+    health = self._cluster_health()
+    response_dict = health.get()
+    if response_dict is None:
+      with self._create_gce() as gce_project:
+        response_dict = gce_appengine.GceAppEngine().run_gce_request(
+            self,
+            health.collect,
+            'Error listing instances: ',
+            gce_project=gce_project,
+            loadbalancers=self._get_lb_servers())
+      if response_dict is None:
+        return
+    health.schedule(users.get_current_user().user_id(),
+                    self._get_lb_servers())
+
+    # Tell the page which scale request the cluster has converged to.
+    objective = self._controller().get()
+    if objective:
+      response_dict['objective'] = objective.status
+
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps(response_dict))
+
+  @oauth_decorator.oauth_required
+  @data_handler.data_required
+  def set_instances(self):
+    """Record the requested number of instances.
+
+    The cluster is scaled in the background by the ClusterController. The
+    response holds the version of the new objective.
+    """
+
+    objective = self._controller().set_target(
+        users.get_current_user().user_id(),
+        int(self.request.get('num_instances')),
+        parameters={
+          'loadbalancers': self._get_lb_servers(),
+          'bucket': data_handler.stored_user_data.get(user_data.GCS_BUCKET),
+        })
+    self._cluster_health().invalidate()
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps(objective.status))
+
+  @oauth_decorator.oauth_required
+  @data_handler.data_required
+  def cleanup(self):
+    """Stop all the instances, in the background like set_instances."""
+
+    objective = self._controller().set_target(
+        users.get_current_user().user_id(), 0)
+    self._cluster_health().invalidate()
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps(objective.status))
+
+  def _get_lb_servers(self):
+    data = data_handler.stored_user_data
+    return data.get(user_data.GCE_LOAD_BALANCER_IP, [])
+
+  def instance_prefix(self):
+    """Return a prefix based on a request/query params."""
+    tag = self.request.get('tag')
+    prefix = DEMO_NAME
+    if tag:
+      prefix = prefix + '-' + tag
+    return prefix
+
+  def _cluster_health(self):
+    """Return the ClusterHealth of the requested cluster."""
+    return ClusterHealth(
+        data_handler.stored_user_data[user_data.GCE_PROJECT_ID],
+        data_handler.stored_user_data[user_data.GCE_ZONE_NAME],
+        self.instance_prefix())
+
+  def _controller(self):
+    """Return the ClusterController of the requested cluster."""
+    return gce_appengine.ClusterController(
+        data_handler.stored_user_data[user_data.GCE_PROJECT_ID],
+        data_handler.stored_user_data[user_data.GCE_ZONE_NAME],
+        self.instance_prefix(),
+        FractalSpec())
+
+  def _create_gce(self):
+    """Check out a pooled GceProject for use in a with block."""
+    gce_project_id = data_handler.stored_user_data[user_data.GCE_PROJECT_ID]
+    gce_zone_name = data_handler.stored_user_data[user_data.GCE_ZONE_NAME]
+    return gce.project_pool.project(oauth_decorator.credentials,
+                                    users.get_current_user().user_id(),
+                                    project_id=gce_project_id,
+                                    zone_name=gce_zone_name)
+
+
 app = webapp2.WSGIApplication(
     [
         ('/%s' % DEMO_NAME, Fractal),
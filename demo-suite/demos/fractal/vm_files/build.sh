@@ -0,0 +1,9 @@
+#! /bin/bash
+# Compile the tile server for the instances.  Run before deploying the app;
+# when a Cloud Storage bucket is configured the binary is published there and
+# instances download it instead of compiling mandelbrot.go on boot.
+set -o errexit
+set -o xtrace
+
+cd $(dirname $0)
+GOOS=linux GOARCH=amd64 go build -ldflags "-s -w" -o mandelbrot mandelbrot.go
@@ -33,6 +33,7 @@ import (
 	"runtime"
 	"strconv"
 	"strings"
+	"sync"
 	"time"
 )
 
@@ -59,6 +60,15 @@ var tileCount = expvar.NewMap("tileCount")
 // A Map of 'size' -> total time in microseconds
 var tileTime = expvar.NewMap("tileTime")
 
+// A Map of 'size' -> Map of latency bucket -> request count.  Buckets are
+// named by their upper bound in milliseconds, see latencyBucketsMs.  The "inf"
+// bucket counts requests slower than the last bound.
+var tileLatency = expvar.NewMap("tileLatency")
+var tileLatencyLock sync.Mutex
+
+// The upper bounds, in milliseconds, of the tileLatency buckets.
+var latencyBucketsMs = []int64{1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000}
+
 const (
 	// The number of iterations of the Mandelbrot calculation.
 	// More iterations mean higher quality at the cost of more CPU time.
@@ -212,7 +222,35 @@ func tileHandler(w http.ResponseWriter, r *http.Request) {
 	w.Header().Set("Content-Length", strconv.Itoa(len(b)))
 	w.Write(b)
 
-	tileTime.Add(strconv.Itoa(tileSize), time.Since(t0).Nanoseconds())
+	elapsed := time.Since(t0)
+	tileTime.Add(strconv.Itoa(tileSize), elapsed.Nanoseconds())
+	recordTileLatency(tileSize, elapsed)
+}
+
+// Count a tile request in the tileLatency bucket for its size and duration.
+func recordTileLatency(tileSize int, elapsed time.Duration) {
+	key := strconv.Itoa(tileSize)
+	tileLatencyLock.Lock()
+	buckets, ok := tileLatency.Get(key).(*expvar.Map)
+	if !ok {
+		// Publish every bucket so that histograms from all servers line up.
+		buckets = new(expvar.Map).Init()
+		for _, bound := range latencyBucketsMs {
+			buckets.Add(strconv.FormatInt(bound, 10), 0)
+		}
+		buckets.Add("inf", 0)
+		tileLatency.Set(key, buckets)
+	}
+	tileLatencyLock.Unlock()
+
+	bucket := "inf"
+	for _, bound := range latencyBucketsMs {
+		if elapsed <= time.Duration(bound)*time.Millisecond {
+			bucket = strconv.FormatInt(bound, 10)
+			break
+		}
+	}
+	buckets.Add(bucket, 1)
 }
 
 func healthHandler(w http.ResponseWriter, r *http.Request) {
@@ -253,6 +291,11 @@ func varResetHandler(w http.ResponseWriter, r *http.Request) {
 	resetVarMap(requestTime)
 	resetVarMap(tileCount)
 	resetVarMap(tileTime)
+	tileLatency.Do(func(kv expvar.KeyValue) {
+		if buckets, ok := kv.Value.(*expvar.Map); ok {
+			resetVarMap(buckets)
+		}
+	})
 
 	w.Header().Set("Content-Type", "text/plain")
 	w.Header().Set("Access-Control-Allow-Origin", "*")
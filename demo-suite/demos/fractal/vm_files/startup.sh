@@ -1,26 +1,69 @@
 #!/bin/bash
-IMAGE_VERSION=2
-IMAGE_MARK=/var/fractal.image.$IMAGE_VERSION
-if [ ! -e $IMAGE_MARK ];
+GMV=/usr/share/google/get_metadata_value
+TILE_SERVER_URL=$($GMV attributes/tile-server-url 2>/dev/null)
+TILE_SERVER_SHA1=$($GMV attributes/tile-server-sha1 2>/dev/null)
+GOPROG_URL=$($GMV attributes/goprog-url 2>/dev/null)
+GOPROG_SHA1=$($GMV attributes/goprog-sha1 2>/dev/null)
+
+cd /tmp
+
+# Use the prebuilt tile server if there is one.  The binary is named after
+# its checksum so a restart doesn't download it again.  If it can't be
+# downloaded or verified, the server is built from source below.
+if [ -n "$TILE_SERVER_URL" ];
 then
-  pushd /tmp
-  curl -O https://go.googlecode.com/files/go1.1.linux-amd64.tar.gz
-  tar -C /usr/local -xzf go1.1.linux-amd64.tar.gz
-  touch $IMAGE_MARK
-  popd
+  TILE_SERVER=/tmp/tile-server-$TILE_SERVER_SHA1
+  if [ ! -x $TILE_SERVER ];
+  then
+    if gsutil cp $TILE_SERVER_URL $TILE_SERVER.download &&
+       echo "$TILE_SERVER_SHA1  $TILE_SERVER.download" | sha1sum -c -;
+    then
+      chmod +x $TILE_SERVER.download
+      mv $TILE_SERVER.download $TILE_SERVER
+    else
+      echo "Could not fetch $TILE_SERVER_URL, building from source"
+      rm -f $TILE_SERVER.download
+    fi
+  fi
 fi
 
-export PATH=$PATH:/usr/local/go/bin
-GMV=/usr/share/google/get_metadata_value
+if [ -n "$TILE_SERVER_URL" ] && [ -x $TILE_SERVER ];
+then
+  PROG_CMD=$TILE_SERVER
+else
+  IMAGE_VERSION=2
+  IMAGE_MARK=/var/fractal.image.$IMAGE_VERSION
+  if [ ! -e $IMAGE_MARK ];
+  then
+    pushd /tmp
+    curl -O https://go.googlecode.com/files/go1.1.linux-amd64.tar.gz
+    tar -C /usr/local -xzf go1.1.linux-amd64.tar.gz
+    touch $IMAGE_MARK
+    popd
+  fi
+
+  export PATH=$PATH:/usr/local/go/bin
+  # The source is published next to the tile server, or else inlined.
+  if [ -n "$GOPROG_URL" ];
+  then
+    until gsutil cp $GOPROG_URL ./program.go &&
+          echo "$GOPROG_SHA1  ./program.go" | sha1sum -c -;
+    do
+      echo "Could not fetch $GOPROG_URL, retrying"
+      sleep 10
+    done
+  else
+    $GMV attributes/goprog > ./program.go
+  fi
+  PROG_CMD="go run ./program.go"
+fi
 
 # Restart the server in the background if it fails.
-cd /tmp
 function runServer {
   while :
   do
-    $GMV attributes/goprog > ./program.go
     PROG_ARGS=$($GMV attributes/goargs)
-    CMDLINE="go run ./program.go $PROG_ARGS"
+    CMDLINE="$PROG_CMD $PROG_ARGS"
     echo "Running $CMDLINE"
     $CMDLINE
   done
@@ -18,6 +18,7 @@ from __future__ import with_statement
 
 __author__ = 'kbrisbin@google.com (Kathryn Hurley)'
 
+import json
 import os
 import random
 
@@ -38,6 +39,11 @@ IMAGE = 'image-magick-demo-image'
 IMAGES = ['android', 'appengine', 'apps', 'chrome', 'games', 'gplus',
           'maps', 'wallet', 'youtube']
 SEQUENCES = ['5 5 360', '355 -5 0']
+STARTUP_SCRIPT = os.path.join(os.path.dirname(__file__), 'startup.sh')
+
+# The startup script only changes with a new app version, so read it once.
+with open(STARTUP_SCRIPT, 'r') as startup_file:
+  STARTUP_SCRIPT_VALUE = startup_file.read()
 
 jinja_environment = jinja2.Environment(loader=jinja2.FileSystemLoader(''))
 oauth_decorator = oauth.decorator
@@ -85,10 +91,11 @@ class Instance(webapp2.RequestHandler):
     """Get and return the list of instances with names containing the tag."""
 
     gce_project_id = data_handler.stored_user_data[user_data.GCE_PROJECT_ID]
-    gce_project = gce.GceProject(
-        oauth_decorator.credentials, project_id=gce_project_id)
-    gce_appengine.GceAppEngine().list_demo_instances(
-        self, gce_project, DEMO_NAME)
+    with gce.project_pool.project(
+        oauth_decorator.credentials, users.get_current_user().user_id(),
+        project_id=gce_project_id) as gce_project:
+      gce_appengine.GceAppEngine().list_demo_instances(
+          self, gce_project, DEMO_NAME)
 
   @data_handler.data_required
   def post(self):
@@ -103,7 +110,6 @@ class Instance(webapp2.RequestHandler):
     credentials = oauth2client.StorageByKeyName(
         oauth2client.CredentialsModel, user.user_id(), 'credentials').get()
     gce_project_id = data_handler.stored_user_data[user_data.GCE_PROJECT_ID]
-    gce_project = gce.GceProject(credentials, project_id=gce_project_id)
 
     # Get the bucket info for the instance metadata.
     gcs_bucket = data_handler.stored_user_data[user_data.GCS_BUCKET]
@@ -115,37 +121,43 @@ class Instance(webapp2.RequestHandler):
     else:
       gcs_path = gcs_bucket
 
-    # Figure out the image.  Use custom image if it exists.
-    (image_project, image_name) = self._get_image_name(gce_project)
+    with gce.project_pool.project(
+        credentials, user.user_id(),
+        project_id=gce_project_id) as gce_project:
+      # Figure out the image.  Use custom image if it exists.
+      (image_project, image_name) = self._get_image_name(gce_project)
 
-    # Create a list of instances to insert.
-    instances = []
-    num_instances = int(self.request.get('num_instances'))
-    for i in range(num_instances):
-      startup_script = os.path.join(os.path.dirname(__file__), 'startup.sh')
-      instances.append(gce.Instance(
-          name='%s-%d' % (DEMO_NAME, i),
+      # Create a list of instances to insert.  Only the name and the
+      # per-VM metadata differ between them.
+      template = gce.InstanceTemplate(
           image_project_id=image_project,
           image_name=image_name,
           service_accounts=gce_project.settings['cloud_service_account'],
           metadata=[
-              {'key': 'startup-script', 'value': open(
-                  startup_script, 'r').read()},
-              {'key': 'image', 'value': random.choice(IMAGES)},
-              {'key': 'seq', 'value': random.choice(SEQUENCES)},
-              {'key': 'machine-num', 'value': i},
+              {'key': 'startup-script', 'value': STARTUP_SCRIPT_VALUE},
               {'key': 'tag', 'value': DEMO_NAME},
-              {'key': 'gcs-path', 'value': gcs_path}]))
-
-    response = gce_appengine.GceAppEngine().run_gce_request(
-        self,
-        gce_project.bulk_insert,
-        'Error inserting instances: ',
-        resources=instances)
-
-    if response:
-      self.response.headers['Content-Type'] = 'text/plain'
-      self.response.out.write('starting cluster')
+              {'key': 'gcs-path', 'value': gcs_path}])
+      instances = []
+      num_instances = int(self.request.get('num_instances'))
+      for i in range(num_instances):
+        instances.append(template.stamp(
+            '%s-%d' % (DEMO_NAME, i),
+            metadata=[
+                {'key': 'image', 'value': random.choice(IMAGES)},
+                {'key': 'seq', 'value': random.choice(SEQUENCES)},
+                {'key': 'machine-num', 'value': i}]))
+
+      response = gce_appengine.GceAppEngine().run_gce_request(
+          self,
+          gce_project.bulk_insert,
+          'Error inserting instances: ',
+          resources=instances)
+
+      if response:
+        gce_appengine.InstanceInventory(
+            gce_project, DEMO_NAME).record_results(response, 'PROVISIONING')
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write('starting cluster')
 
   def _get_image_name(self, gce_project):
     """Finds the appropriate image to use.
@@ -156,7 +168,8 @@ class Instance(webapp2.RequestHandler):
     Returns:
       A tuple containing the image project and image name.
     """
-    if gce_project.list_images(filter='name eq ^%s-$' % IMAGE):
+    if gce_project.list_images(filter='name eq ^%s-$' % IMAGE,
+                               projection=('name',)):
       return (gce_project.project_id, IMAGE)
     return ('google', None)
 
@@ -172,14 +185,34 @@ class GceCleanup(webapp2.RequestHandler):
     credentials = oauth2client.StorageByKeyName(
         oauth2client.CredentialsModel, user.user_id(), 'credentials').get()
     gce_project_id = data_handler.stored_user_data[user_data.GCE_PROJECT_ID]
-    gce_project = gce.GceProject(credentials, project_id=gce_project_id)
-    gce_appengine.GceAppEngine().delete_demo_instances(
-        self, gce_project, DEMO_NAME)
+    with gce.project_pool.project(
+        credentials, user.user_id(),
+        project_id=gce_project_id) as gce_project:
+      gce_appengine.GceAppEngine().delete_demo_instances(
+          self, gce_project, DEMO_NAME)
 
 
 class GcsCleanup(webapp2.RequestHandler):
   """Remove Cloud Storage files."""
 
+  @data_handler.data_required
+  def get(self):
+    """Return the progress of the cleanup with the given job id."""
+
+    user_id = users.get_current_user().user_id()
+    credentials = oauth2client.StorageByKeyName(
+        oauth2client.CredentialsModel, user_id, 'credentials').get()
+    gcs_project_id = data_handler.stored_user_data[user_data.GCS_PROJECT_ID]
+    gcs_helper = gcs_appengine.GcsAppEngineHelper(credentials, gcs_project_id)
+    status = None
+    job_id = self.request.get('job')
+    if job_id.isdigit():
+      status = gcs_helper.get_cleanup_status(int(job_id))
+    if not status:
+      self.abort(404)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps(status))
+
   @data_handler.data_required
   def post(self):
     """Remove all cloud storage contents from the given bucket and dir."""
@@ -197,10 +230,10 @@ class GcsCleanup(webapp2.RequestHandler):
       file_regex = r'^%s/%s.*' % (gcs_directory, DEMO_NAME)
     else:
       file_regex = r'^%s.*' % DEMO_NAME
-    gcs_helper.delete_bucket_contents(
-        gcs_bucket, gcs_directory, file_regex)
-    self.response.headers['Content-Type'] = 'text/plain'
-    self.response.out.write('cleaning cloud storage bucket')
+    job_id = gcs_helper.delete_bucket_contents(
+        user_id, gcs_bucket, gcs_directory, file_regex)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps({'job': job_id}))
 
 
 app = webapp2.WSGIApplication(
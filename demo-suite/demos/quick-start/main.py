@@ -18,57 +18,44 @@ from __future__ import with_statement
 
 __author__ = 'kbrisbin@google.com (Kathryn Hurley)'
 
+import json
 import lib_path
-import logging
 import google_cloud.gce as gce
 import google_cloud.gce_appengine as gce_appengine
 import google_cloud.oauth as oauth
 import jinja2
-import oauth2client.appengine as oauth2client
-import time
 import user_data
 import webapp2
 
-from google.appengine.ext import ndb
 from google.appengine.api import users
+from google.appengine.ext import ndb
 
 DEMO_NAME = 'quick-start'
 
+
 class Objective(ndb.Model):
-  """ This data model keeps track of work in progress. """
+  """The work in progress, as recorded before ClusterObjective.
+
+  Entities are keyed by project. They are only read to migrate them, see
+  get_objective.
+  """
   # Disable caching of objective.
   _use_memcache = False
   _use_cache = False
 
-  # Desired number of VMs and start time. This will be >0 for a start
-  # request or 0 for a reset/stop request.
   targetVMs = ndb.IntegerProperty()
-
-  # Number of VMs started by last start request. This is handy when
-  # recovering during a reset operation, so we can figure out how many 
-  # instances to depict in the UI.
   startedVMs = ndb.IntegerProperty()
-
-  # Epoch time when last/current request was stated.
   startTime = ndb.IntegerProperty()
 
-def getObjective(project_id):
-  key = ndb.Key("Objective", project_id)
-  return key.get()
-
-@ndb.transactional
-def updateObjective(project_id, targetVMs):
-  objective = getObjective(project_id)
-  if not objective: 
-    logging.info('objective not found, creating new, project=' + project_id)
-    key = ndb.Key("Objective", project_id)
-    objective = Objective(key=key)
-  objective.targetVMs = targetVMs
-  # Overwrite startedVMs only when starting, skip when stopping.
-  if targetVMs > 0:
-    objective.startedVMs = targetVMs 
-  objective.startTime = int(time.time())
-  objective.put()
+
+class QuickStartSpec(gce_appengine.ClusterSpec):
+  """Describes the instances of the quick start cluster."""
+
+  def build_instances(self, gce_project, objective, listings):
+    """Return the requested number of default instances."""
+    template = gce.InstanceTemplate(zone_name=objective.zone_name)
+    return [template.stamp('%s-%d' % (DEMO_NAME, i))
+            for i in range(objective.target_instances)]
 
 jinja_environment = jinja2.Environment(loader=jinja2.FileSystemLoader(''))
 oauth_decorator = oauth.decorator
@@ -94,11 +81,10 @@ class QuickStart(webapp2.RequestHandler):
     startedVMs = 5
     startTime = 0
 
-    gce_project_id = data_handler.stored_user_data[user_data.GCE_PROJECT_ID]
-    objective = getObjective(gce_project_id)
+    objective = get_objective(users.get_current_user().user_id())
     if objective:
-      (targetVMs, startedVMs, startTime) = (objective.targetVMs, 
-        objective.startedVMs, objective.startTime)
+      (targetVMs, startedVMs, startTime) = (objective.target_instances,
+        objective.started_instances, objective.start_time)
 
     variables = {
       'demo_name': DEMO_NAME,
@@ -124,39 +110,25 @@ class Instance(webapp2.RequestHandler):
 
     gce_project_id = data_handler.stored_user_data[user_data.GCE_PROJECT_ID]
     gce_zone_name = data_handler.stored_user_data[user_data.GCE_ZONE_NAME]
-    gce_project = gce.GceProject(
-        oauth_decorator.credentials, project_id=gce_project_id,
-        zone_name=gce_zone_name)
-    gce_appengine.GceAppEngine().list_demo_instances(
-        self, gce_project, DEMO_NAME)
+    with gce.project_pool.project(
+        oauth_decorator.credentials, users.get_current_user().user_id(),
+        project_id=gce_project_id, zone_name=gce_zone_name) as gce_project:
+      gce_appengine.GceAppEngine().list_demo_instances(
+          self, gce_project, DEMO_NAME)
 
   @data_handler.data_required
   def post(self):
-    """Start instances using the gce_appengine helper class."""
-
-    gce_project_id = data_handler.stored_user_data[user_data.GCE_PROJECT_ID]
-    gce_zone_name = data_handler.stored_user_data[user_data.GCE_ZONE_NAME]
-    user_id = users.get_current_user().user_id()
-    credentials = oauth2client.StorageByKeyName(
-        oauth2client.CredentialsModel, user_id, 'credentials').get()
-    gce_project = gce.GceProject(credentials, project_id=gce_project_id,
-        zone_name=gce_zone_name)
+    """Record the requested number of instances.
 
-    num_instances = int(self.request.get('num_instances'))
-    instances = [gce.Instance('%s-%d' % (DEMO_NAME, i), zone_name=gce_zone_name)
-                 for i in range(num_instances)]
-    response = gce_appengine.GceAppEngine().run_gce_request(
-        self,
-        gce_project.bulk_insert,
-        'Error inserting instances: ',
-        resources=instances)
-
-    # Record objective in datastore so we can recover work in progress.
-    updateObjective(gce_project_id, num_instances)
+    The instances are started in the background by the ClusterController.
+    The response holds the version of the new objective.
+    """
 
-    if response:
-      self.response.headers['Content-Type'] = 'text/plain'
-      self.response.out.write('starting cluster')
+    objective = get_controller().set_target(
+        users.get_current_user().user_id(),
+        int(self.request.get('num_instances')))
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps(objective.status))
 
 
 class Cleanup(webapp2.RequestHandler):
@@ -164,19 +136,45 @@ class Cleanup(webapp2.RequestHandler):
 
   @data_handler.data_required
   def post(self):
-    """Stop instances using the gce_appengine helper class."""
-    gce_project_id = data_handler.stored_user_data[user_data.GCE_PROJECT_ID]
-    gce_zone_name = data_handler.stored_user_data[user_data.GCE_ZONE_NAME]
-    user_id = users.get_current_user().user_id()
-    credentials = oauth2client.StorageByKeyName(
-        oauth2client.CredentialsModel, user_id, 'credentials').get()
-    gce_project = gce.GceProject(credentials, project_id=gce_project_id,
-        zone_name=gce_zone_name)
-    gce_appengine.GceAppEngine().delete_demo_instances(
-        self, gce_project, DEMO_NAME)
-
-    # Record reset objective in datastore so we can recover work in progress.
-    updateObjective(gce_project_id, 0)
+    """Stop all the instances, in the background like Instance.post."""
+
+    objective = get_controller().set_target(
+        users.get_current_user().user_id(), 0)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps(objective.status))
+
+
+def get_controller():
+  """Return the ClusterController of the current user's cluster."""
+  return gce_appengine.ClusterController(
+      data_handler.stored_user_data[user_data.GCE_PROJECT_ID],
+      data_handler.stored_user_data[user_data.GCE_ZONE_NAME],
+      DEMO_NAME,
+      QuickStartSpec())
+
+
+def get_objective(user_id):
+  """Return the current user's ClusterObjective, or None.
+
+  A legacy Objective of the project is migrated to a ClusterObjective the
+  first time it is found, then deleted.
+
+  Args:
+    user_id: The string id of the current user.
+  """
+  controller = get_controller()
+  objective = controller.get()
+  if objective:
+    return objective
+  legacy_key = ndb.Key(Objective, controller.project_id)
+  legacy = legacy_key.get()
+  if not legacy:
+    return None
+  objective = controller.adopt(
+      user_id, legacy.targetVMs or 0, legacy.startedVMs or 0,
+      legacy.startTime)
+  legacy_key.delete()
+  return objective
 
 app = webapp2.WSGIApplication(
     [
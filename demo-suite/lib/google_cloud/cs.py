@@ -16,15 +16,194 @@
 
 __author__ = 'kbrisbin@google.com (Kathryn Hurley)'
 
+import collections
 import datetime
+import heapq
 import logging
 import re
-from xml.dom import minidom
+import sre_constants
+import sre_parse
+import time
+import urllib
+from xml.etree import cElementTree
+from xml.sax import saxutils
 
 from google.appengine.api import urlfetch
 
 BASE_URL = 'https://storage.googleapis.com'
 API_VERSION = '2'
+# Deadline, in seconds, of upload requests.
+UPLOAD_DEADLINE = 60
+# Deadline, in seconds, of listing and delete requests.
+REQUEST_DEADLINE = 10
+# The maximum number of deletes in flight at once.
+DELETE_WINDOW = 50
+# The maximum number of bulk uploads in flight at once.
+UPLOAD_WINDOW = 20
+# The number of bytes of a listing fed to the parser at a time.
+PARSE_CHUNK_SIZE = 64 * 1024
+# Bytes sent per request by resumable uploads. Must be a multiple of 256KB.
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+# Bytes per part of composite uploads, and the number of parts in flight.
+COMPOSITE_PART_SIZE = 8 * 1024 * 1024
+COMPOSITE_WINDOW = 4
+# The maximum number of components of a compose request.
+COMPOSE_LIMIT = 32
+# Suffixes of the temporary objects of composite uploads.
+PART_SUFFIX = '.part-'
+COMPOSE_SUFFIX = '.compose-'
+# Retries of a failed upload request, and the first delay in seconds.
+UPLOAD_RETRIES = 4
+UPLOAD_RETRY_DELAY = 1
+RETRYABLE_STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+
+# An object of a bucket listing.
+CsObject = collections.namedtuple('CsObject', ['name', 'size', 'etag'])
+# One page of a bucket listing. next_marker is None on the last page.
+CsListing = collections.namedtuple(
+    'CsListing', ['objects', 'prefixes', 'next_marker'])
+
+
+# The outcome of one object of a bulk upload. error is None on success.
+BulkUploadResult = collections.namedtuple(
+    'BulkUploadResult',
+    ['name', 'size', 'status', 'attempts', 'seconds', 'error'])
+
+
+class UploadStats(collections.namedtuple(
+    'UploadStats', ['name', 'size', 'seconds', 'requests'])):
+  """The size, duration and number of requests of an upload."""
+
+  @property
+  def throughput(self):
+    """The bytes uploaded per second."""
+    if not self.seconds:
+      return 0.0
+    return self.size / self.seconds
+
+
+class CsError(Exception):
+  """Exception raised when a Cloud Storage request fails."""
+  pass
+
+
+def listing_filter(directory=None, file_regex=None):
+  """Return the listing prefix and name filter for a directory and regex.
+
+  The longest literal prefix of the regex is pushed down to the listing, so
+  unrelated objects aren't listed. The regex is only left to match on the
+  client when something follows that prefix that can fail to match.
+
+  Args:
+    directory: A symbolic directory the object names must be in.
+    file_regex: A regular expression the object names must match.
+
+  Returns:
+    A tuple with the string listing prefix, or None if no object name can
+    match, and the compiled regex names must still match, or None.
+  """
+  prefix = ''
+  if directory:
+    prefix = '%s/' % directory
+  if not file_regex:
+    return prefix, None
+  literal, exhaustive = _regex_prefix(file_regex)
+  if literal.startswith(prefix):
+    prefix = literal
+  elif not prefix.startswith(literal):
+    return None, None
+  if exhaustive:
+    return prefix, None
+  return prefix, re.compile(file_regex)
+
+
+def _regex_prefix(file_regex):
+  """Return the literal prefix of a regex used with re.match.
+
+  Args:
+    file_regex: A regular expression.
+
+  Returns:
+    A tuple with the string every match starts with, and whether every
+    name starting with it matches.
+  """
+  parsed = sre_parse.parse(file_regex)
+  if parsed.pattern.flags & sre_parse.SRE_FLAG_IGNORECASE:
+    return '', False
+  to_char = chr
+  if isinstance(file_regex, unicode):
+    to_char = unichr
+  literal = []
+  items = list(parsed)
+  while items:
+    op, value = items[0]
+    if op == sre_constants.LITERAL:
+      literal.append(to_char(value))
+    elif literal or op != sre_constants.AT or value not in (
+        sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING):
+      break
+    items.pop(0)
+  # re.match isn't anchored at the end, so a trailing repeat that can match
+  # nothing, such as .*, matches every name.
+  exhaustive = not items or (
+      len(items) == 1 and
+      items[0][0] in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and
+      items[0][1][0] == 0)
+  return ''.join(literal), exhaustive
+
+
+class _ListingParser(object):
+  """Parser target collecting the objects of a bucket listing.
+
+  The listing is parsed incrementally, and each object is added to objects
+  as soon as its Contents element ends.
+
+  Attributes:
+    objects: A deque of the parsed CsObjects not consumed yet.
+    prefixes: A list of the CommonPrefixes of a delimited listing.
+    truncated: Whether the listing has more pages.
+    next_marker: The string NextMarker of the listing, if any.
+  """
+
+  def __init__(self):
+    """Initializes the _ListingParser class."""
+    self.objects = collections.deque()
+    self.prefixes = []
+    self.truncated = False
+    self.next_marker = None
+    self._path = []
+    self._text = []
+    self._object = {}
+
+  def start(self, tag, attrib):
+    # Drop the XML namespace of the tag.
+    self._path.append(tag.split('}')[-1])
+    self._text = []
+
+  def data(self, data):
+    self._text.append(data)
+
+  def end(self, tag):
+    name = self._path.pop()
+    text = ''.join(self._text)
+    self._text = []
+    if self._path[-1:] == ['Contents']:
+      self._object[name] = text
+    elif name == 'Contents':
+      self.objects.append(CsObject(
+          self._object.get('Key'),
+          int(self._object.get('Size') or 0),
+          self._object.get('ETag', '').strip('"')))
+      self._object = {}
+    elif self._path[-1:] == ['CommonPrefixes'] and name == 'Prefix':
+      self.prefixes.append(text)
+    elif name == 'IsTruncated':
+      self.truncated = text == 'true'
+    elif name == 'NextMarker':
+      self.next_marker = text
+
+  def close(self):
+    pass
 
 
 class Cs(object):
@@ -56,69 +235,637 @@ class Cs(object):
       content_type: String name describing the content type.
     Returns:
       The string result of the API call.
+
+    Raises:
+      CsError: Raised when the upload is not successful.
     """
-    # TODO(kbrisbin): This hasn't been tested yet.
-    url = '%s/%s/%s' % (BASE_URL, bucket, object_name)
-    date = datetime.datetime.now()
-    str_date = date.strftime('%b %d, %Y %H:%M:%S')
+    url = self._object_url(bucket, object_name)
+    headers = self._headers(oauth_token)
+    headers['Content-Type'] = content_type
     result = urlfetch.fetch(
         url=url, payload=payload, method=urlfetch.PUT,
-        headers={
-            'Authorization': 'OAuth %s' % (oauth_token),
-            'Date': str_date,
-            'x-goog-project-id': self.project_id,
-            'x-goog-api-version': API_VERSION,
-            'Content-Type': content_type})
+        deadline=UPLOAD_DEADLINE, headers=headers)
+    if result.status_code != 200:
+      raise CsError('Error uploading %s: %d %s' % (
+          url, result.status_code, result.content))
     return result.content
 
+  def bulk_upload(self, oauth_token, bucket, items, window=UPLOAD_WINDOW):
+    """Uploads many objects with up to window requests in flight.
+
+    The authorization and content type headers are built once and shared by
+    every request. Objects that fail with a retryable status are retried
+    with backoff, up to UPLOAD_RETRIES times, without holding up the rest of
+    the window. Failures don't stop the upload; they are reported in the
+    results.
+
+    Args:
+      oauth_token: String oauth token for sending authorized requests.
+      bucket: String name of bucket in which to upload files.
+      items: An iterable of (object_name, payload) or (object_name, payload,
+          content_type) tuples. The content type defaults to text/plain.
+      window: The maximum number of requests in flight.
+
+    Returns:
+      A dictionary of object name -> BulkUploadResult.
+    """
+    started = time.time()
+    base_headers = self._headers(oauth_token)
+    content_headers = {}
+    results = {}
+    in_flight = collections.deque()
+    # A heap of (ready time, sequence, upload) for uploads awaiting a retry.
+    retries = []
+    items = iter(items)
+    sequence = 0
+    size = 0
+    requests = 0
+
+    while True:
+      while len(in_flight) < window:
+        if retries and retries[0][0] <= time.time():
+          upload = heapq.heappop(retries)[-1]
+        else:
+          item = next(items, None)
+          if item is None:
+            break
+          object_name, payload = item[:2]
+          content_type = 'text/plain'
+          if len(item) > 2:
+            content_type = item[2]
+          headers = content_headers.get(content_type)
+          if headers is None:
+            headers = dict(base_headers)
+            headers['Content-Type'] = content_type
+            content_headers[content_type] = headers
+          # [name, payload, headers, attempts, start time, rpc]
+          upload = [object_name, payload, headers, 0, time.time(), None]
+          size += len(payload)
+        upload[3] += 1
+        upload[5] = urlfetch.create_rpc(deadline=UPLOAD_DEADLINE)
+        urlfetch.make_fetch_call(
+            upload[5], self._object_url(bucket, upload[0]), payload=upload[1],
+            method=urlfetch.PUT, headers=upload[2])
+        in_flight.append(upload)
+        requests += 1
+
+      if not in_flight:
+        if not retries:
+          break
+        time.sleep(max(0, retries[0][0] - time.time()))
+        continue
+
+      upload = in_flight.popleft()
+      object_name, payload, _, attempts, upload_started, rpc = upload
+      status = None
+      try:
+        result = rpc.get_result()
+        status = result.status_code
+        error = '%d %s' % (status, result.content)
+      except urlfetch.Error, e:
+        error = str(e)
+      if status == 200:
+        error = None
+      elif (attempts <= UPLOAD_RETRIES and
+            (status is None or status in RETRYABLE_STATUSES)):
+        logging.warning('Retrying upload of %s after error: %s',
+                        object_name, error)
+        upload[5] = None
+        ready = time.time() + UPLOAD_RETRY_DELAY * 2 ** (attempts - 1)
+        heapq.heappush(retries, (ready, sequence, upload))
+        sequence += 1
+        continue
+      results[object_name] = BulkUploadResult(
+          object_name, len(payload), status, attempts,
+          time.time() - upload_started, error)
+
+    failed = sum(1 for result in results.values() if result.error)
+    if failed:
+      logging.error('Could not upload %d of %d objects to %s',
+                    failed, len(results), bucket)
+    self._log_upload('bulk', UploadStats(
+        '%d objects' % len(results), size, time.time() - started, requests))
+    return results
+
+  def exists(self, oauth_token, bucket, object_name):
+    """Checks whether an object is in a bucket.
+
+    Args:
+      oauth_token: String oauth token for sending authorized requests.
+      bucket: String name of the bucket.
+      object_name: String name of the object.
+
+    Returns:
+      True if the object exists, False if it doesn't.
+
+    Raises:
+      CsError: Raised when the request fails.
+    """
+    url = self._object_url(bucket, object_name)
+    result = urlfetch.fetch(url=url, method=urlfetch.HEAD,
+                            headers=self._headers(oauth_token),
+                            deadline=REQUEST_DEADLINE)
+    if result.status_code == 404:
+      return False
+    if result.status_code != 200:
+      raise CsError('Error checking %s: %d %s' % (
+          url, result.status_code, result.content))
+    return True
+
+  def upload_resumable(self, oauth_token, bucket, object_name, source,
+                       content_type='application/octet-stream',
+                       chunk_size=UPLOAD_CHUNK_SIZE):
+    """Uploads an object in chunks read from a file-like source.
+
+    Only the chunk being sent is held in memory. A chunk that fails is
+    resumed from the offset the server committed, up to UPLOAD_RETRIES
+    times.
+
+    Args:
+      oauth_token: String oauth token for sending authorized requests.
+      bucket: String name of bucket in which to upload file.
+      object_name: String name of the object.
+      source: A file-like object to read the contents from.
+      content_type: String name describing the content type.
+      chunk_size: The number of bytes sent per request, a multiple of 256KB.
+
+    Returns:
+      The UploadStats of the upload.
+
+    Raises:
+      CsError: Raised when the upload is not successful.
+    """
+    started = time.time()
+    url = self._object_url(bucket, object_name)
+    headers = self._headers(oauth_token)
+    start_headers = dict(headers)
+    start_headers['x-goog-resumable'] = 'start'
+    start_headers['Content-Type'] = content_type
+    result = urlfetch.fetch(url=url, payload='', method=urlfetch.POST,
+                            headers=start_headers, deadline=REQUEST_DEADLINE)
+    if result.status_code != 201:
+      raise CsError('Error starting upload of %s: %d %s' % (
+          url, result.status_code, result.content))
+    upload_url = result.headers['Location']
+
+    offset = 0
+    requests = 1
+    chunk = source.read(chunk_size)
+    while True:
+      # Read ahead to tell whether this is the last chunk, so its request
+      # can give the total size.
+      following = ''
+      if len(chunk) == chunk_size:
+        following = source.read(chunk_size)
+      total = None
+      if not following:
+        total = offset + len(chunk)
+      requests += self._send_chunk(upload_url, headers, chunk, offset, total)
+      offset += len(chunk)
+      if total is not None:
+        break
+      chunk = following
+
+    stats = UploadStats(object_name, offset, time.time() - started, requests)
+    self._log_upload('resumable', stats)
+    return stats
+
+  def upload_composite(self, oauth_token, bucket, object_name, source,
+                       content_type='application/octet-stream',
+                       part_size=COMPOSITE_PART_SIZE,
+                       window=COMPOSITE_WINDOW):
+    """Uploads an object as parallel parts composed by Cloud Storage.
+
+    Parts are read from the source and uploaded as temporary objects, with
+    up to window of them in flight. They are then composed into the object
+    and deleted. Failed parts are retried up to UPLOAD_RETRIES times.
+
+    Args:
+      oauth_token: String oauth token for sending authorized requests.
+      bucket: String name of bucket in which to upload file.
+      object_name: String name of the object.
+      source: A file-like object to read the contents from.
+      content_type: String name describing the content type.
+      part_size: The number of bytes per part.
+      window: The maximum number of parts in flight.
+
+    Returns:
+      The UploadStats of the upload.
+
+    Raises:
+      CsError: Raised when the upload is not successful.
+    """
+    started = time.time()
+    headers = self._headers(oauth_token)
+    part_names = []
+    in_flight = collections.deque()
+    size = 0
+    requests = 0
+    while True:
+      data = source.read(part_size)
+      if not data and part_names:
+        break
+      if len(in_flight) >= window:
+        requests += self._finish_part(in_flight.popleft(), headers)
+      part_name = '%s%s%04d' % (object_name, PART_SUFFIX, len(part_names))
+      in_flight.append(self._start_part(bucket, part_name, data, headers))
+      part_names.append(part_name)
+      size += len(data)
+      if not data:
+        break
+    while in_flight:
+      requests += self._finish_part(in_flight.popleft(), headers)
+
+    temporary, compose_requests = self._compose(
+        bucket, object_name, part_names, content_type, headers)
+    temporary = part_names + temporary
+    requests += len(part_names) + compose_requests + len(temporary)
+    errors = self._delete_objects(bucket, temporary, headers)
+    for name, error in errors.items():
+      logging.warning('Could not delete temporary object %s: %s', name, error)
+
+    stats = UploadStats(object_name, size, time.time() - started, requests)
+    self._log_upload('composite', stats)
+    return stats
+
   def delete_bucket_contents(self, oauth_token, bucket, directory=None,
                              file_regex=None):
     """Deletes all the contents of a given bucket / directory.
 
+    The listing is narrowed to the literal prefix of file_regex, see
+    listing_filter. Every page of the listing is read, and the deletes are
+    sent as asynchronous requests with up to DELETE_WINDOW of them in flight.
+
     Args:
       oauth_token: String oauth token for sending authorized requests.
       bucket: String name of bucket in which to upload file.
       directory: A symbolic directory from which to delete objects.
       file_regex: A regular expression to match against object names.
+
+    Returns:
+      A dictionary of object name -> string error for the objects that
+      could not be deleted.
     """
+    prefix, pattern = listing_filter(directory, file_regex)
+    if prefix is None:
+      return {}
+    logging.info('Deleting files from: %s/%s', bucket, prefix)
+    names = (cs_object.name for cs_object
+             in self.iter_objects(oauth_token, bucket, prefix or None)
+             if not pattern or pattern.match(cs_object.name))
+    errors = self._delete_objects(bucket, names, self._headers(oauth_token))
+    if errors:
+      logging.error('Could not delete %d objects from %s', len(errors), bucket)
+    return errors
+
+  def iter_objects(self, oauth_token, bucket, prefix=None):
+    """Iterates over the objects in a bucket.
+
+    The listing is followed page by page using the marker parameter, and
+    each page is parsed incrementally, so objects are yielded without
+    building the whole document.
+
+    Args:
+      oauth_token: String oauth token for sending authorized requests.
+      bucket: String name of the bucket.
+      prefix: String prefix the object names must start with.
+
+    Returns:
+      An iterator of CsObjects with the name, size and etag of the objects.
+
+    Raises:
+      CsError: Raised when a listing request fails.
+    """
+    marker = None
+    while True:
+      content = self._fetch_listing(oauth_token, bucket, prefix, marker)
+      listing = _ListingParser()
+      parser = cElementTree.XMLParser(target=listing)
+      last = None
+      for start in xrange(0, len(content), PARSE_CHUNK_SIZE):
+        parser.feed(content[start:start + PARSE_CHUNK_SIZE])
+        while listing.objects:
+          last = listing.objects.popleft()
+          yield last
+      parser.close()
+      while listing.objects:
+        last = listing.objects.popleft()
+        yield last
+
+      if not listing.truncated or not last:
+        return
+      marker = listing.next_marker or last.name
+
+  def list_page(self, oauth_token, bucket, prefix=None, marker=None,
+                delimiter=None):
+    """Lists one page of the objects in a bucket.
+
+    Args:
+      oauth_token: String oauth token for sending authorized requests.
+      bucket: String name of the bucket.
+      prefix: String prefix the object names must start with.
+      marker: String name after which the page starts, from the next_marker
+          of the previous page.
+      delimiter: String delimiter grouping the names below the prefix into
+          common prefixes, for example '/'.
+
+    Returns:
+      A CsListing with the objects and common prefixes of the page, and the
+      marker of the next page.
+
+    Raises:
+      CsError: Raised when the listing request fails.
+    """
+    content = self._fetch_listing(
+        oauth_token, bucket, prefix, marker, delimiter)
+    listing = _ListingParser()
+    parser = cElementTree.XMLParser(target=listing)
+    parser.feed(content)
+    parser.close()
+    objects = list(listing.objects)
+    next_marker = None
+    if listing.truncated:
+      next_marker = listing.next_marker or max(
+          [o.name for o in objects] + listing.prefixes)
+    return CsListing(objects, listing.prefixes, next_marker)
+
+  def delete_objects(self, oauth_token, bucket, names):
+    """Deletes the given objects from a bucket.
+
+    The deletes are sent as asynchronous requests with up to DELETE_WINDOW
+    of them in flight. Objects that don't exist count as deleted.
+
+    Args:
+      oauth_token: String oauth token for sending authorized requests.
+      bucket: String name of the bucket.
+      names: An iterable of the string names of the objects to delete.
+
+    Returns:
+      A dictionary of object name -> string error for the objects that
+      could not be deleted.
+    """
+    return self._delete_objects(bucket, names, self._headers(oauth_token))
+
+  def _fetch_listing(self, oauth_token, bucket, prefix=None, marker=None,
+                     delimiter=None):
+    """Return the XML content of one page of a bucket listing.
+
+    Raises:
+      CsError: Raised when the listing request fails.
+    """
+    params = {}
+    if prefix:
+      params['prefix'] = prefix
+    if marker:
+      params['marker'] = marker
+    if delimiter:
+      params['delimiter'] = delimiter
     url = '%s/%s' % (BASE_URL, bucket)
-    if directory:
-      url = '%s?prefix=%s/' % (url, directory)
-    logging.info('Deleting files from: ' + url)
-    date = datetime.datetime.now()
-    str_date = date.strftime('%b %d, %Y %H:%M:%S')
-    result = urlfetch.fetch(
-        url=url, headers={
-            'Authorization': 'OAuth %s' % (oauth_token),
-            'Date': str_date,
-            'x-goog-project-id': self.project_id,
-            'x-goog-api-version': API_VERSION})
-    dom = minidom.parseString(result.content)
-    keys = dom.getElementsByTagName('Key')
-    for key_element in keys:
-      key = self._get_text(key_element.childNodes)
-      if file_regex and not re.match(file_regex, key):
+    if params:
+      url = '%s?%s' % (url, urllib.urlencode(params))
+    result = urlfetch.fetch(url=url, headers=self._headers(oauth_token),
+                            deadline=REQUEST_DEADLINE)
+    if result.status_code != 200:
+      raise CsError('Error listing %s: %d %s' % (
+          url, result.status_code, result.content))
+    return result.content
+
+  def _delete_objects(self, bucket, names, headers):
+    """Deletes objects with up to DELETE_WINDOW requests in flight.
+
+    Args:
+      bucket: String name of the bucket.
+      names: An iterable of the string names of the objects to delete.
+      headers: A dictionary of the headers of the requests.
+
+    Returns:
+      A dictionary of object name -> string error for the objects that
+      could not be deleted.
+    """
+    errors = {}
+    in_flight = collections.deque()
+    for name in names:
+      if len(in_flight) >= DELETE_WINDOW:
+        self._finish_delete(in_flight.popleft(), errors)
+      url = self._object_url(bucket, name)
+      logging.debug('Deleting: %s', url)
+      rpc = urlfetch.create_rpc(deadline=REQUEST_DEADLINE)
+      urlfetch.make_fetch_call(
+          rpc, url, method=urlfetch.DELETE, headers=headers)
+      in_flight.append((name, rpc))
+    while in_flight:
+      self._finish_delete(in_flight.popleft(), errors)
+    return errors
+
+  def _send_chunk(self, upload_url, headers, chunk, offset, total):
+    """Sends a chunk of a resumable upload, resuming it after failures.
+
+    Args:
+      upload_url: The string URL of the resumable upload.
+      headers: A dictionary of the headers of the requests.
+      chunk: The string bytes to send.
+      offset: The offset of the chunk in the object.
+      total: The size of the object if this is the last chunk, else None.
+
+    Returns:
+      The number of requests sent.
+
+    Raises:
+      CsError: Raised when the chunk can't be sent.
+    """
+    end = offset + len(chunk)
+    size = '*'
+    if total is not None:
+      size = total
+    position = offset
+    query = False
+    failures = 0
+    requests = 0
+    while True:
+      chunk_headers = dict(headers)
+      data = ''
+      if query or position == end:
+        # Ask how much was committed, or finish an empty object.
+        chunk_headers['Content-Range'] = 'bytes */%s' % size
+      else:
+        data = chunk[position - offset:]
+        chunk_headers['Content-Range'] = 'bytes %d-%d/%s' % (
+            position, end - 1, size)
+      status = None
+      try:
+        result = urlfetch.fetch(url=upload_url, payload=data,
+                                method=urlfetch.PUT, headers=chunk_headers,
+                                deadline=UPLOAD_DEADLINE)
+        status = result.status_code
+        message = '%d %s' % (status, result.content)
+      except urlfetch.Error, e:
+        message = str(e)
+      requests += 1
+
+      if status in (200, 201):
+        return requests
+      if status == 308:
+        # The server committed bytes 0 to the end of its Range header.
+        committed = 0
+        committed_range = result.headers.get('Range')
+        if committed_range:
+          committed = int(committed_range.split('-')[-1]) + 1
+        if committed < offset:
+          raise CsError('Upload lost data before offset %d' % offset)
+        query = False
+        position = committed
+        if position >= end and total is None:
+          return requests
         continue
-      url = '%s/%s/%s' % (BASE_URL, bucket, key)
-      logging.info('Deleting: %s', url)
-      result = urlfetch.fetch(
-          url=url, method=urlfetch.DELETE, headers={
-              'Authorization': 'OAuth %s' % (oauth_token),
-              'Date': str_date,
-              'x-goog-project-id': self.project_id,
-              'x-goog-api-version': API_VERSION})
 
-  def _get_text(self, nodes):
-    """Concatenates the text from several XML nodes.
+      failures += 1
+      if (failures > UPLOAD_RETRIES or
+          (status is not None and status not in RETRYABLE_STATUSES)):
+        raise CsError('Error uploading to %s: %s' % (upload_url, message))
+      logging.warning('Resuming upload after error: %s', message)
+      time.sleep(UPLOAD_RETRY_DELAY * 2 ** (failures - 1))
+      query = True
+
+  def _start_part(self, bucket, part_name, data, headers):
+    """Starts the upload of a part of a composite upload.
+
+    Args:
+      bucket: String name of the bucket.
+      part_name: The string name of the part object.
+      data: The string contents of the part.
+      headers: A dictionary of the headers of the request.
+
+    Returns:
+      A tuple with the bucket, part name, data and urlfetch RPC.
+    """
+    part_headers = dict(headers)
+    part_headers['Content-Type'] = 'application/octet-stream'
+    rpc = urlfetch.create_rpc(deadline=UPLOAD_DEADLINE)
+    urlfetch.make_fetch_call(rpc, self._object_url(bucket, part_name),
+                             payload=data, method=urlfetch.PUT,
+                             headers=part_headers)
+    return (bucket, part_name, data, rpc)
+
+  def _finish_part(self, part, headers):
+    """Waits for a part upload, retrying it until it succeeds.
+
+    Args:
+      part: A tuple with the bucket, part name, data and urlfetch RPC.
+      headers: A dictionary of the headers of the requests.
+
+    Returns:
+      The number of retries sent.
+
+    Raises:
+      CsError: Raised when the part can't be uploaded.
+    """
+    bucket, part_name, data, rpc = part
+    retries = 0
+    while True:
+      status = None
+      try:
+        result = rpc.get_result()
+        status = result.status_code
+        message = '%d %s' % (status, result.content)
+      except urlfetch.Error, e:
+        message = str(e)
+      if status == 200:
+        return retries
+      if (retries >= UPLOAD_RETRIES or
+          (status is not None and status not in RETRYABLE_STATUSES)):
+        raise CsError('Error uploading part %s: %s' % (part_name, message))
+      retries += 1
+      logging.warning('Retrying part %s after error: %s', part_name, message)
+      time.sleep(UPLOAD_RETRY_DELAY * 2 ** (retries - 1))
+      rpc = self._start_part(bucket, part_name, data, headers)[-1]
+
+  def _compose(self, bucket, object_name, names, content_type, headers):
+    """Composes objects into one, in tiers of up to COMPOSE_LIMIT.
+
+    Args:
+      bucket: String name of the bucket.
+      object_name: String name of the composed object.
+      names: A list of the string names of the objects to compose, in order.
+      content_type: String name describing the content type.
+      headers: A dictionary of the headers of the requests.
+
+    Returns:
+      A tuple with the list of names of the intermediate objects created,
+      and the number of compose requests sent.
+
+    Raises:
+      CsError: Raised when a compose request is not successful.
+    """
+    temporary = []
+    requests = 0
+    while True:
+      groups = [names[i:i + COMPOSE_LIMIT]
+                for i in range(0, len(names), COMPOSE_LIMIT)]
+      final = len(groups) == 1
+      composed = []
+      for group in groups:
+        if final:
+          target = object_name
+        else:
+          target = '%s%s%04d' % (object_name, COMPOSE_SUFFIX, len(temporary))
+          temporary.append(target)
+        body = ''.join(
+            '<Component><Name>%s</Name></Component>' % saxutils.escape(name)
+            for name in group)
+        compose_headers = dict(headers)
+        compose_headers['Content-Type'] = content_type
+        url = self._object_url(bucket, target) + '?compose'
+        result = urlfetch.fetch(
+            url=url, payload='<ComposeRequest>%s</ComposeRequest>' % body,
+            method=urlfetch.PUT, headers=compose_headers,
+            deadline=REQUEST_DEADLINE)
+        requests += 1
+        if result.status_code != 200:
+          raise CsError('Error composing %s: %d %s' % (
+              url, result.status_code, result.content))
+        composed.append(target)
+      if final:
+        return temporary, requests
+      names = composed
+
+  def _log_upload(self, mode, stats):
+    """Logs the size, duration and throughput of an upload."""
+    logging.info('Uploaded %s (%s): %d bytes in %.2fs, %d requests, '
+                 '%.1f KB/s', stats.name, mode, stats.size, stats.seconds,
+                 stats.requests, stats.throughput / 1024)
+
+  def _finish_delete(self, delete, errors):
+    """Waits for an asynchronous delete and records any error.
+
+    Args:
+      delete: A tuple with the string object name and the urlfetch RPC.
+      errors: A dictionary of object name -> string error to update.
+    """
+    key, rpc = delete
+    try:
+      result = rpc.get_result()
+      # The object may have been deleted already.
+      if result.status_code not in (200, 204, 404):
+        errors[key] = '%d %s' % (result.status_code, result.content)
+    except urlfetch.Error, e:
+      errors[key] = str(e)
+
+  def _object_url(self, bucket, object_name):
+    """Returns the URL of an object."""
+    return '%s/%s/%s' % (BASE_URL, bucket, urllib.quote(object_name))
+
+  def _headers(self, oauth_token):
+    """Returns the headers of an authorized request.
 
     Args:
-      nodes: List of XML nodes.
+      oauth_token: String oauth token for sending authorized requests.
 
     Returns:
-      A string of concatenated text nodes.
+      A dictionary of headers, shared by the requests of an operation.
     """
-    rc = []
-    for node in nodes:
-      if node.nodeType == node.TEXT_NODE:
-        rc.append(node.data)
-    return ''.join(rc)
+    date = datetime.datetime.now()
+    return {
+        'Authorization': 'OAuth %s' % (oauth_token),
+        'Date': date.strftime('%b %d, %Y %H:%M:%S'),
+        'x-goog-project-id': self.project_id,
+        'x-goog-api-version': API_VERSION}
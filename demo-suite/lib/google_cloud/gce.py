@@ -16,8 +16,14 @@
 
 __author__ = 'kbrisbin@google.com (Kathryn Hurley)'
 
+import collections
+import contextlib
 import logging
 import os
+import random
+import sys
+import threading
+import time
 
 import lib_path
 from apiclient import discovery
@@ -36,6 +42,177 @@ import gce_exception as error
 API = 'compute'
 GCE_URL = 'https://www.googleapis.com/%s' % API
 GOOGLE_PROJECT = 'centos-cloud'
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/%s/%s/rest'
+DISCOVERY_DIR = os.path.join(
+    os.path.dirname(__file__), '../../discovery', API)
+POOL_SIZE = 50
+BATCH_SIZE = 50
+BATCH_CONCURRENCY = 4
+BATCH_RETRIES = 4
+RETRY_DELAY = 1
+POLL_MIN_INTERVAL = 1
+POLL_MAX_INTERVAL = 10
+
+# Discovery documents, keyed by API version. These are shared by every
+# GceProject in the process, so the document is fetched only once. The JSON
+# string is cached rather than the parsed document because
+# build_from_document modifies the document it is given.
+_discovery_docs = {}
+# API version -> (discovery document, service built from it). The services
+# are shared by every GceProject; credentials are bound per request.
+_services = {}
+_discovery_lock = threading.Lock()
+
+
+def get_discovery_doc(api_version, local=False):
+  """Returns the Compute Engine discovery document.
+
+  The document is loaded on first use and cached for the life of the process.
+  When local is True, the copy bundled in the discovery directory is used
+  and a background thread fetches the published document, replacing the
+  cached copy if its revision differs.
+
+  Args:
+    api_version: The string API version, ex: v1beta15.
+    local: True to load the bundled discovery document.
+
+  Returns:
+    The JSON string of the discovery document.
+
+  Raises:
+    GceError: Raised when the discovery document can't be retrieved.
+  """
+
+  discovery_doc = _discovery_docs.get(api_version)
+  if discovery_doc:
+    return discovery_doc
+
+  with _discovery_lock:
+    discovery_doc = _discovery_docs.get(api_version)
+    if not discovery_doc:
+      if local:
+        discovery_doc = _load_discovery_doc(api_version)
+        thread = threading.Thread(
+            target=_refresh_discovery_doc, args=(api_version,))
+        thread.daemon = True
+        thread.start()
+      else:
+        discovery_doc = _fetch_discovery_doc(api_version)
+      _discovery_docs[api_version] = discovery_doc
+  return discovery_doc
+
+
+def get_service(api_version, local=False):
+  """Returns the Compute Engine service shared by every GceProject.
+
+  The service is built once per discovery document, with an unauthorized
+  http object, so requests built from it must be executed with an
+  authorized one.
+
+  Args:
+    api_version: The string API version, ex: v1beta15.
+    local: True to load the bundled discovery document.
+
+  Returns:
+    An apiclient.discovery.Resource object for Compute Engine.
+
+  Raises:
+    GceError: Raised when the discovery document can't be retrieved.
+  """
+
+  discovery_doc = get_discovery_doc(api_version, local)
+  cached = _services.get(api_version)
+  if cached and cached[0] is discovery_doc:
+    return cached[1]
+
+  with _discovery_lock:
+    cached = _services.get(api_version)
+    if not cached or cached[0] is not discovery_doc:
+      service = discovery.build_from_document(
+          discovery_doc, http=httplib2.Http(memcache, timeout=30))
+      _prepare_resources(service)
+      cached = (discovery_doc, service)
+      _services[api_version] = cached
+  return cached[1]
+
+
+def _prepare_resources(resource):
+  """Creates every nested resource of a service once.
+
+  Creating a resource fixes up the method descriptions it shares with the
+  service, adding keys to them. Doing it here, before the service is shared,
+  means concurrent requests only replace existing keys.
+
+  Args:
+    resource: An apiclient.discovery.Resource object.
+  """
+
+  for name in dir(resource):
+    attr = getattr(resource, name)
+    if getattr(attr, '__is_resource__', False):
+      _prepare_resources(attr())
+
+
+def _load_discovery_doc(api_version):
+  """Loads the discovery document bundled with the app.
+
+  Args:
+    api_version: The string API version.
+
+  Returns:
+    The JSON string of the discovery document.
+  """
+
+  discovery_doc_path = os.path.join(DISCOVERY_DIR, '%s.json' % api_version)
+  return open(discovery_doc_path, 'r').read()
+
+
+def _fetch_discovery_doc(api_version):
+  """Fetches the published discovery document.
+
+  Args:
+    api_version: The string API version.
+
+  Returns:
+    The JSON string of the discovery document.
+
+  Raises:
+    GceError: Raised when the discovery document can't be retrieved.
+  """
+
+  url = DISCOVERY_URL % (API, api_version)
+  try:
+    response, content = httplib2.Http(memcache, timeout=30).request(url)
+  except httplib2.HttpLib2Error, e:
+    logging.error(e)
+    raise error.GceError('Transport Error occurred')
+  if response.status >= 400:
+    raise error.GceError(
+        'Discovery Error: %s %s' % (response.status, response.reason))
+  return content
+
+
+def _refresh_discovery_doc(api_version):
+  """Replaces the cached discovery document if a newer one is published.
+
+  Args:
+    api_version: The string API version.
+  """
+
+  try:
+    discovery_doc = _fetch_discovery_doc(api_version)
+    revision = json.loads(discovery_doc).get('revision')
+    cached_revision = json.loads(
+        _discovery_docs.get(api_version, '{}')).get('revision')
+  except (error.GceError, ValueError), e:
+    logging.warning('Discovery freshness check failed: %s', e)
+    return
+
+  if revision != cached_revision:
+    logging.info('Bundled %s discovery document is stale (%s != %s).',
+                 api_version, cached_revision, revision)
+    with _discovery_lock:
+      _discovery_docs[api_version] = discovery_doc
 
 
 class GceProject(object):
@@ -46,7 +223,10 @@ class GceProject(object):
     gce_url: The string URL of the Compute Engine API endpoint.
     project_id: A string name for the Compute Engine project.
     zone_name: A string name for the default zone.
-    service: An apiclient.discovery.Resource object for Compute Engine.
+    credentials: The oauth2client.client.Credentials object in use.
+    service: An apiclient.discovery.Resource object for Compute Engine, shared
+        by every GceProject. Its requests are run with auth_http.
+    auth_http: The httplib2.Http object authorized with credentials.
   """
 
   def __init__(
@@ -76,16 +256,11 @@ class GceProject(object):
     api_version = self.settings['compute']['api_version']
     self.gce_url = '%s/%s' % (GCE_URL, api_version)
 
-    # Ability to build API from a local discovery doc is disabled here,
-    # by commenting out code. We're not removing the code altogether, 
-    # in case we ever want to revert to using a local discovery doc.
-    #discovery_doc_path = 'discovery/compute/%s.json' % api_version
-    #discovery_doc = open(discovery_doc_path, 'r').read()
-
-    auth_http = self._auth_http(credentials)
-    #self.service = discovery.build_from_document(
-      #discovery_doc, api_version, http=auth_http)
-    self.service = discovery.build('compute', api_version, http=auth_http)
+    self.credentials = None
+    self.auth_http = None
+    self.service = get_service(
+        api_version, self.settings['compute'].get('local_discovery', False))
+    self.set_credentials(credentials)
 
     self.project_id = project_id
     if not self.project_id:
@@ -95,63 +270,164 @@ class GceProject(object):
     if not self.zone_name:
       self.zone_name = self.settings['compute']['zone']
 
-  def list_instances(self, zone_name=None, **args):
-    """Lists all instances for a project and zone with an optional filter.
+  def set_credentials(self, credentials):
+    """Binds credentials to the project's requests.
+
+    The service is shared per process, so only the authorized http object is
+    built here. Nothing is rebuilt if the credentials hold the same access
+    token as the ones already bound, which keeps the http object and its open
+    connections alive.
+
+    Args:
+      credentials: An oauth2client.client.Credentials object.
+    """
+
+    if (self.auth_http and
+        self.credentials.access_token == credentials.access_token):
+      self.credentials = credentials
+      return
+
+    self.auth_http = self._auth_http(credentials)
+    self.credentials = credentials
+    self._batch_auth_https = []
+    self._prefetch_https = []
 
-    Args represent any optional parameters for the list instances request.
-    See the API documentation:
+  def iter_instances(self, zone_name=None, projection=None, **args):
+    """Iterates over instances for a project and zone, page by page.
+
+    The first page is fetched when this method is called, so API errors are
+    raised immediately. The following pages are fetched in the background
+    while the caller handles the current page. Args represent any optional
+    parameters for the list instances request. See the API documentation:
 
     https://developers.google.com/compute/docs/reference/v1beta14/instances/list
 
+    A projection limits the response to the given fields of each resource,
+    using the API's partial response selector. The returned resources then
+    only have those attributes set; the others have their default values.
+
     Args:
       zone_name: The zone in which to query.
+      projection: A list of the string field paths to return, for example
+          ['name', 'networkInterfaces/accessConfigs/natIP']. Whole resources
+          are returned if None.
+
+    Returns:
+      An iterator of Instance objects.
+    """
+    return self._iter(Instance, zone_name=zone_name, projection=projection,
+                      **args)
+
+  def list_instances(self, zone_name=None, projection=None, **args):
+    """Lists all instances for a project and zone with an optional filter.
+
+    See iter_instances for the optional parameters.
+
+    Args:
+      zone_name: The zone in which to query.
+      projection: A list of the string field paths to return.
 
     Returns:
       A list of Instance objects.
     """
-    return self._list(Instance, zone_name=zone_name, **args)
+    return list(self.iter_instances(zone_name=zone_name,
+                                    projection=projection, **args))
 
-  def list_firewalls(self, **args):
-    """Lists all firewalls for a project.
+  def iter_firewalls(self, projection=None, **args):
+    """Iterates over firewalls for a project, page by page.
 
-    Args represent any optional parameters for the list firewalls request.
-    See the API documentation:
+    See iter_instances for how pages are fetched. Args represent any optional
+    parameters for the list firewalls request. See the API documentation:
 
     https://developers.google.com/compute/docs/reference/v1beta14/firewalls/list
 
+    Args:
+      projection: A list of the string field paths to return, see
+          iter_instances.
+
+    Returns:
+      An iterator of Firewall objects.
+    """
+
+    return self._iter(Firewall, projection=projection, **args)
+
+  def list_firewalls(self, projection=None, **args):
+    """Lists all firewalls for a project.
+
+    See iter_firewalls for the optional parameters.
+
+    Args:
+      projection: A list of the string field paths to return.
+
     Returns:
       A list of Firewall objects.
     """
 
-    return self._list(Firewall, **args)
+    return list(self.iter_firewalls(projection=projection, **args))
 
-  def list_images(self, **args):
-    """Lists all images for a project.
+  def iter_images(self, projection=None, **args):
+    """Iterates over images for a project, page by page.
 
-    Args represent any optional parameters for the list images request.
-    See the API documentation:
+    See iter_instances for how pages are fetched. Args represent any optional
+    parameters for the list images request. See the API documentation:
 
     https://developers.google.com/compute/docs/reference/v1beta14/images/list
 
+    Args:
+      projection: A list of the string field paths to return, see
+          iter_instances.
+
+    Returns:
+      An iterator of Image objects.
+    """
+
+    return self._iter(Image, projection=projection, **args)
+
+  def list_images(self, projection=None, **args):
+    """Lists all images for a project.
+
+    See iter_images for the optional parameters.
+
+    Args:
+      projection: A list of the string field paths to return.
+
     Returns:
       A list of Image objects.
     """
 
-    return self._list(Image, **args)
+    return list(self.iter_images(projection=projection, **args))
 
-  def list_disks(self, **args):
-    """Lists all disks for a project.
+  def iter_disks(self, projection=None, **args):
+    """Iterates over disks for a project, page by page.
 
-    Args represent any optional parameters for the list disks request.
-    See the API documentation:
+    See iter_instances for how pages are fetched. Args represent any optional
+    parameters for the list disks request. See the API documentation:
 
     https://developers.google.com/compute/docs/reference/v1beta14/disks/list
 
+    Args:
+      projection: A list of the string field paths to return, see
+          iter_instances.
+
+    Returns:
+      An iterator of Disk objects.
+    """
+
+    return self._iter(Disk, projection=projection, **args)
+
+  def list_disks(self, projection=None, **args):
+    """Lists all disks for a project.
+
+    See iter_disks for the optional parameters.
+
+    Args:
+      projection: A list of the string field paths to return.
+
     Returns:
       A list of Disk objects.
     """
 
-    return self._list(Disk, **args)
+    return list(self.iter_disks(projection=projection, **args))
 
   def insert(self, resource):
     """Insert a resource into the GCE project.
@@ -174,91 +450,301 @@ class GceProject(object):
     except error.GceTokenError:
       raise
 
-  def bulk_insert(self, resources):
-    """Insert multiple resources using a batch request.
+  def bulk_insert(self, resources, batch_size=BATCH_SIZE,
+                  concurrency=BATCH_CONCURRENCY):
+    """Insert multiple resources using batch requests.
+
+    Resources are split into batches of batch_size requests, and up to
+    concurrency batches are sent at once. Requests that fail with a
+    transient error are retried with exponential backoff. Failures,
+    including failures of whole batches, are reported in the results rather
+    than raised.
 
     Args:
       resources: A list of GceResource objects.
+      batch_size: The maximum number of requests in a batch.
+      concurrency: The maximum number of batches sent at once.
 
-    Raises:
-      GceError: Raised when API call fails.
-      GceTokenError: Raised when the access token fails to refresh.
+    Returns:
+      A list of BatchResult objects, one per resource, in the order of
+      resources.
     """
 
-    batch = http.BatchHttpRequest()
+    requests = []
     for resource in resources:
       resource.gce_project = self
-      batch.add(self._insert_request(resource), callback=self._batch_response)
+      requests.append(self._insert_request(resource))
+    return self._run_batches(resources, requests, batch_size, concurrency)
 
-    try:
-      self._run_request(batch)
-    except error.GceError:
-      raise
-    except error.GceTokenError:
-      raise
+  def bulk_delete(self, resources, batch_size=BATCH_SIZE,
+                  concurrency=BATCH_CONCURRENCY):
+    """Delete resources using batch requests.
 
-  def bulk_delete(self, resources):
-    """Delete resources using a batch request.
+    Resources are split into batches of batch_size requests, and up to
+    concurrency batches are sent at once. Requests that fail with a
+    transient error are retried with exponential backoff. Failures,
+    including failures of whole batches, are reported in the results rather
+    than raised.
 
     Args:
       resources: A list of GceResource objects.
+      batch_size: The maximum number of requests in a batch.
+      concurrency: The maximum number of batches sent at once.
 
-    Raises:
-      GceError: Raised when API call fails.
-      GceTokenError: Raised when the access token fails to refresh.
+    Returns:
+      A list of BatchResult objects, one per resource, in the order of
+      resources.
     """
 
-    batch = http.BatchHttpRequest()
+    requests = []
     for resource in resources:
       resource.gce_project = self
-      batch.add(self._delete_request(resource), callback=self._batch_response)
+      requests.append(self._delete_request(resource))
+    return self._run_batches(resources, requests, batch_size, concurrency)
 
-    try:
+  def get_operations(self, operations, batch_size=BATCH_SIZE):
+    """Fetch the current state of several operations using batch requests.
+
+    Zonal operations are fetched with zoneOperations.get and global ones with
+    globalOperations.get.
+
+    Args:
+      operations: A list of dictionaries representing operations.
+      batch_size: The maximum number of requests in a batch.
+
+    Returns:
+      A list with the latest dictionary for each operation, in the order of
+      operations. Operations that could not be fetched are None.
+
+    Raises:
+      GceError: Raised when API call fails.
+      GceTokenError: Raised when the access token fails to refresh.
+    """
+
+    latest = [None] * len(operations)
+
+    def batch_response(request_id, response, exception):
+      self._batch_response(request_id, response, exception)
+      latest[int(request_id)] = response
+
+    for start in xrange(0, len(operations), batch_size):
+      batch = http.BatchHttpRequest()
+      for index in xrange(start, min(start + batch_size, len(operations))):
+        operation = operations[index]
+        params = {'project': self.project_id, 'operation': operation['name']}
+        if operation.get('zone'):
+          params['zone'] = operation['zone'].split('/')[-1]
+          request = self.service.zoneOperations().get(**params)
+        else:
+          request = self.service.globalOperations().get(**params)
+        batch.add(request, callback=batch_response, request_id=str(index))
       self._run_request(batch)
-    except error.GceError:
-      raise
-    except error.GceTokenError:
-      raise
+    return latest
+
+  def list_batch(self, queries):
+    """Lists several types of resources with a single batch request.
 
-  def _list(self, resource_class, zone_name=None, **args):
-    """Get a list of all project resources of type resource_class.
+    The first page of every listing is fetched in one batch request. The
+    following pages, if any, are then fetched listing by listing.
+
+    Args:
+      queries: A dictionary of string key -> (resource_class, args) tuple,
+          where args is a dictionary of the keyword arguments the list
+          method of resource_class takes, such as zone_name, projection or
+          filter.
+
+    Returns:
+      A dictionary of key -> list of resource_class objects.
+
+    Raises:
+      GceError: Raised when API call fails.
+      GceTokenError: Raised when the access token fails to refresh.
+    """
+
+    resources = {}
+    requests = {}
+    pages = {}
+    errors = []
+
+    def batch_response(request_id, response, exception):
+      self._batch_response(request_id, response, exception)
+      if exception is not None:
+        errors.append(self._api_error(exception))
+      pages[request_id] = response
+
+    batch = http.BatchHttpRequest()
+    for key, (resource_class, args) in queries.items():
+      resource = resource_class()
+      resource.gce_project = self
+      resources[key] = resource
+      requests[key] = self._list_request(resource, **args)
+      batch.add(requests[key], callback=batch_response, request_id=key)
+    self._run_request(batch)
+    if errors:
+      raise errors[0]
+
+    listings = {}
+    for key, (resource_class, args) in queries.items():
+      service_resource = resources[key].service_resource()
+      listing = []
+      request = requests[key]
+      page = pages[key]
+      while page:
+        listing.extend(
+            resource_class.wrap(item) for item in page.get('items', []))
+        request = service_resource.list_next(request, page)
+        page = None
+        if request:
+          page = self._run_request(request)
+      listings[key] = listing
+    return listings
+
+  def _iter(self, resource_class, zone_name=None, projection=None, **args):
+    """Iterate over all project resources of type resource_class.
+
+    The first page is fetched before returning. While the caller consumes a
+    page, the next one is fetched in the background.
 
     Args:
       resource_class: A class of type GceResource.
       zone_name: A string zone to apply to the request, if applicable.
+      projection: A list of the string field paths to return, or None for
+          whole resources.
 
     Returns:
-      A list of resource_class objects.
+      An iterator of resource_class objects.
 
     Raises:
       GceError: Raised when API call fails.
       GceTokenError: Raised when the access token fails to refresh.
     """
 
-    resources = []
     resource = resource_class()
     resource.gce_project = self
 
-    request = self._list_request(resource, zone_name=zone_name, **args)
-    while request:
-      results = {}
-      try:
-        results = self._run_request(request)
-      except error.GceError:
-        raise
-      except error.GceTokenError:
-        raise
+    results = self._run_request(self._list_request(
+        resource, zone_name=zone_name, projection=projection, **args))
+
+    def iter_pages(results):
+      # Each background request takes an idle http object of the project
+      # and gives it back once done, so iterations reuse their connections
+      # but concurrent ones never share an httplib2.Http object.
+      while results:
+        request = resource.service_resource().list_next(
+            self._list_request(resource, zone_name=zone_name,
+                               projection=projection, **args),
+            results)
+        next_page = None
+        if request:
+          prefetch_https = self._prefetch_https
+          if prefetch_https:
+            prefetch_http = prefetch_https.pop()
+          else:
+            prefetch_http = self._auth_http(self.credentials)
+          next_page = BackgroundCall(
+              self._run_request, request, http=prefetch_http)
+
+        for result in results.get('items', []):
+          yield resource_class.wrap(result)
+
+        results = None
+        if next_page:
+          try:
+            results = next_page.get_result()
+          finally:
+            # Dropped instead if the credentials changed meanwhile.
+            prefetch_https.append(prefetch_http)
+
+    return iter_pages(results)
+
+  def _run_batches(self, resources, requests, batch_size, concurrency,
+                   retries=BATCH_RETRIES):
+    """Send requests in batches, retrying requests that fail transiently.
+
+    Requests that fail with a GceRetryableError, on their own or with their
+    whole batch, are resent in new batches after an exponential backoff with
+    jitter, up to retries times. Other requests are not resent.
+
+    Args:
+      resources: A list of GceResource objects.
+      requests: A list of apiclient.http.HttpRequest objects, one per resource.
+      batch_size: The maximum number of requests in a batch.
+      concurrency: The maximum number of batches sent at once.
+      retries: The maximum number of times a request is resent.
 
-      for result in results.get('items', []):
-        new_resource = resource_class()
-        new_resource.from_json(result)
-        resources.append(new_resource)
+    Returns:
+      A list of BatchResult objects, in the order of requests.
+    """
+
+    results = [BatchResult(resource) for resource in resources]
+    pending = range(len(requests))
+    for attempt in xrange(retries + 1):
+      if attempt:
+        delay = RETRY_DELAY * 2 ** (attempt - 1)
+        logging.info('Retrying %d requests in %.1f seconds.',
+                     len(pending), delay)
+        time.sleep(random.uniform(delay / 2.0, delay))
+      self._send_batches(requests, pending, results, batch_size, concurrency)
+      pending = [i for i in pending if results[i].retryable]
+      if not pending:
+        break
+    return results
+
+  def _send_batches(self, requests, indexes, results, batch_size,
+                    concurrency):
+    """Send requests in batches, several batches at a time.
+
+    Batches are sent in waves of up to concurrency batches. Each batch in a
+    wave runs in its own thread with its own http object. When a whole batch
+    fails, every request of the batch is given the batch's error, so the
+    results of the other batches are kept.
+
+    Args:
+      requests: A list of apiclient.http.HttpRequest objects.
+      indexes: A list of the indexes of the requests to send.
+      results: A list of BatchResult objects, updated with each response.
+      batch_size: The maximum number of requests in a batch.
+      concurrency: The maximum number of batches sent at once.
+    """
 
-      request = resource.service_resource().list_next(
-          self._list_request(resource, zone_name=zone_name, **args),
-          results)
+    def batch_response(request_id, response, exception):
+      self._batch_response(request_id, response, exception)
+      result = results[int(request_id)]
+      result.operation = response
+      result.error = None
+      if exception is not None:
+        result.error = self._api_error(exception)
 
-    return resources
+    def send_batch(batch, batch_indexes, http=None):
+      try:
+        self._run_request(batch, http=http)
+      except (error.GceError, error.GceTokenError), e:
+        logging.error('Batch of %d requests failed: %s', len(batch_indexes), e)
+        for index in batch_indexes:
+          results[index].operation = None
+          results[index].error = e
+
+    batches = []
+    for start in xrange(0, len(indexes), batch_size):
+      batch = http.BatchHttpRequest()
+      batch_indexes = indexes[start:start + batch_size]
+      for index in batch_indexes:
+        batch.add(requests[index], callback=batch_response,
+                  request_id=str(index))
+      batches.append((batch, batch_indexes))
+
+    if len(batches) == 1:
+      send_batch(*batches[0])
+      return
+
+    for start in xrange(0, len(batches), concurrency):
+      calls = []
+      for i, (batch, batch_indexes) in enumerate(
+          batches[start:start + concurrency]):
+        calls.append(BackgroundCall(
+            send_batch, batch, batch_indexes, http=self._batch_http(i)))
+      for call in calls:
+        call.get_result()
 
   def _insert_request(self, resource):
     """Construct an insert request for the resource.
@@ -276,12 +762,14 @@ class GceProject(object):
       params['zone'] = self.zone_name
     return resource.service_resource().insert(**params)
 
-  def _list_request(self, resource, zone_name=None, **args):
-    """Construct an insert request for the resource.
+  def _list_request(self, resource, zone_name=None, projection=None, **args):
+    """Construct a list request for the resource.
 
     Args:
       resource: A GceResource object.
       zone_name: The string zone name. Only applicable for zonal resources.
+      projection: A list of the string field paths to return, or None for
+          whole resources.
 
     Returns:
       The list method of the apiclient.discovery.Resource object.
@@ -290,6 +778,9 @@ class GceProject(object):
     params = {'project': self.project_id}
     if args:
       params.update(args)
+    if projection:
+      # The page token must be kept for list_next to fetch the next page.
+      params['fields'] = 'items(%s),nextPageToken' % ','.join(projection)
     if resource.scope == 'zonal':
       if not zone_name:
         zone_name = self.zone_name
@@ -312,11 +803,12 @@ class GceProject(object):
       params['zone'] = self.zone_name
     return resource.service_resource().delete(**params)
 
-  def _run_request(self, request):
+  def _run_request(self, request, http=None):
     """Run API request and handle any errors.
 
     Args:
       request: An apiclient.http.HttpRequest object.
+      http: An authorized httplib2.Http object to use instead of auth_http.
 
     Returns:
       Dictionary results of the API call.
@@ -328,10 +820,10 @@ class GceProject(object):
 
     result = {}
     try:
-      result = request.execute()
+      result = request.execute(http=http or self.auth_http)
     except httplib2.HttpLib2Error, e:
       logging.error(e)
-      raise error.GceError('Transport Error occurred')
+      raise error.GceRetryableError('Transport Error occurred')
     except client.AccessTokenRefreshError, e:
       logging.error(e)
       raise error.GceTokenError('Access Token refresh error')
@@ -339,14 +831,33 @@ class GceProject(object):
       logging.error(e)
       logging.error('BatchError: %s %s' % (e.resp.status, e.content))
       if e.resp.status != 200:
-        raise error.GceError(
+        raise error.api_error(
+            e.resp.status, None,
             'Batch Error: %s %s' % (e.resp.status, e.resp.reason))
     except api_errors.HttpError, e:
       logging.error(e)
-      raise error.GceError(
-          'HttpError: %s %s' % (e.resp.status, e.resp.reason))
+      raise self._api_error(e)
     return result
 
+  def _api_error(self, http_error):
+    """Convert an API error response into a GceError.
+
+    Args:
+      http_error: An apiclient.errors.HttpError object.
+
+    Returns:
+      A GceRetryableError if the error is transient, a GceError otherwise.
+    """
+
+    reason = None
+    try:
+      reason = json.loads(http_error.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+      pass
+    return error.api_error(
+        http_error.resp.status, reason,
+        'HttpError: %s %s' % (http_error.resp.status, http_error.resp.reason))
+
   def _batch_response(self, request_id, response, exception):
     """Log information about the batch request response.
 
@@ -361,6 +872,20 @@ class GceProject(object):
       logging.error(exception)
       logging.error('API Request Error! ' + str(response))
 
+  def _batch_http(self, index):
+    """Return the authorized http object for a concurrent batch.
+
+    Args:
+      index: The position of the batch within its wave.
+
+    Returns:
+      An authorized instance of httplib2.Http.
+    """
+
+    while len(self._batch_auth_https) <= index:
+      self._batch_auth_https.append(self._auth_http(self.credentials))
+    return self._batch_auth_https[index]
+
   def _auth_http(self, credentials):
     """Authorize an instance of httplib2.Http using credentials.
 
@@ -376,24 +901,482 @@ class GceProject(object):
     return auth_http
 
 
+class BatchResult(object):
+  """The result of one request sent in a batch.
+
+  Attributes:
+    resource: The GceResource the request was sent for.
+    operation: A dictionary representing the operation returned by the API,
+        or None if the request failed.
+    error: A GceError or GceTokenError if the request or its batch failed,
+        or None.
+  """
+
+  def __init__(self, resource):
+    """Initializes the BatchResult class.
+
+    Args:
+      resource: The GceResource the request was sent for.
+    """
+
+    self.resource = resource
+    self.operation = None
+    self.error = None
+
+  @property
+  def retryable(self):
+    """Whether the request failed with an error that can be retried."""
+
+    return isinstance(self.error, error.GceRetryableError)
+
+
+class OperationTracker(object):
+  """Tracks operations until they are DONE.
+
+  All pending operations are polled together with a single batch request per
+  tick. The polling interval starts at min_interval, grows while no
+  operation completes and drops back once one does.
+
+  Example:
+    tracker = OperationTracker(gce_project)
+    tracker.add_results(gce_project.bulk_insert(instances))
+    tracker.add_callback(lambda operations: logging.info('All done.'))
+    tracker.wait(timeout=60)
+
+  Attributes:
+    gce_project: The GceProject owning the operations.
+    min_interval: The shortest number of seconds between polls.
+    max_interval: The longest number of seconds between polls.
+    operations: A dictionary of operation name -> latest operation
+        dictionary, for all tracked operations.
+  """
+
+  def __init__(self, gce_project, min_interval=POLL_MIN_INTERVAL,
+               max_interval=POLL_MAX_INTERVAL):
+    """Initializes the OperationTracker class.
+
+    Args:
+      gce_project: The GceProject owning the operations.
+      min_interval: The shortest number of seconds between polls.
+      max_interval: The longest number of seconds between polls.
+    """
+
+    self.gce_project = gce_project
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.operations = {}
+    self._interval = min_interval
+    self._operation_callbacks = {}
+    self._callbacks = []
+
+  @property
+  def pending(self):
+    """A list of the operations that are not DONE yet."""
+
+    return [operation for operation in self.operations.values()
+            if operation.get('status') != 'DONE']
+
+  @property
+  def done(self):
+    """Whether all tracked operations are DONE."""
+
+    return not self.pending
+
+  def add(self, operation, callback=None):
+    """Starts tracking an operation.
+
+    Args:
+      operation: A dictionary representing the operation.
+      callback: A function called with the operation dictionary once the
+          operation is DONE.
+    """
+
+    self.operations[operation['name']] = operation
+    if callback:
+      self._operation_callbacks[operation['name']] = callback
+    self._interval = self.min_interval
+    if operation.get('status') == 'DONE':
+      self._complete(operation)
+
+  def add_results(self, batch_results, callback=None):
+    """Starts tracking the operations returned by a bulk request.
+
+    Args:
+      batch_results: A list of BatchResult objects.
+      callback: A function called with each operation dictionary once the
+          operation is DONE.
+    """
+
+    for result in batch_results:
+      if result.operation:
+        self.add(result.operation, callback)
+
+  def add_callback(self, callback):
+    """Adds a function to call once all tracked operations are DONE.
+
+    The function is called right away if nothing is pending.
+
+    Args:
+      callback: A function called with the list of all operation
+          dictionaries.
+    """
+
+    if self.done:
+      callback(self.operations.values())
+    else:
+      self._callbacks.append(callback)
+
+  def poll(self):
+    """Fetches all pending operations with one batch request.
+
+    Returns:
+      The number of operations still pending.
+
+    Raises:
+      GceError: Raised when API call fails.
+      GceTokenError: Raised when the access token fails to refresh.
+    """
+
+    pending = self.pending
+    if not pending:
+      return 0
+
+    completed = False
+    latest = self.gce_project.get_operations(pending)
+    for operation in latest:
+      if not operation:
+        continue
+      self.operations[operation['name']] = operation
+      if operation.get('status') == 'DONE':
+        completed = True
+        self._complete(operation)
+
+    if completed:
+      self._interval = self.min_interval
+    else:
+      self._interval = min(self._interval * 2, self.max_interval)
+    return len(self.pending)
+
+  def wait(self, timeout=None):
+    """Polls until all operations are DONE or the timeout expires.
+
+    Args:
+      timeout: The number of seconds to wait, or None to wait until DONE.
+
+    Returns:
+      True if all operations are DONE.
+
+    Raises:
+      GceError: Raised when API call fails.
+      GceTokenError: Raised when the access token fails to refresh.
+    """
+
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+    while self.poll():
+      delay = self._interval
+      if deadline is not None:
+        delay = min(delay, deadline - time.time())
+        if delay <= 0:
+          return False
+      time.sleep(delay)
+    return True
+
+  def _complete(self, operation):
+    """Runs the callbacks for a DONE operation.
+
+    Args:
+      operation: A dictionary representing the DONE operation.
+    """
+
+    if operation.get('error'):
+      logging.error('Operation %s failed: %s', operation['name'],
+                    operation['error'])
+    callback = self._operation_callbacks.pop(operation['name'], None)
+    if callback:
+      callback(operation)
+    if self.done:
+      callbacks, self._callbacks = self._callbacks, []
+      for callback in callbacks:
+        callback(self.operations.values())
+
+
+class BackgroundCall(threading.Thread):
+  """Runs a function in a background thread.
+
+  Attributes:
+    function: The callable to run.
+  """
+
+  def __init__(self, function, *args, **kwargs):
+    """Initializes the BackgroundCall class and starts the thread.
+
+    Args:
+      function: The callable to run.
+      *args: Positional arguments for the function.
+      **kwargs: Keyword arguments for the function.
+    """
+
+    super(BackgroundCall, self).__init__()
+    self.daemon = True
+    self.function = function
+    self._args = args
+    self._kwargs = kwargs
+    self._result = None
+    self._exc_info = None
+    self.start()
+
+  def run(self):
+    """Runs the function, saving its result or exception."""
+
+    try:
+      self._result = self.function(*self._args, **self._kwargs)
+    except Exception:
+      self._exc_info = sys.exc_info()
+
+  def get_result(self):
+    """Waits for the function to finish.
+
+    Returns:
+      The function's return value.
+
+    Raises:
+      Any exception raised by the function.
+    """
+
+    self.join()
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+
+class GceProjectPool(object):
+  """A pool of reusable, authorized GceProject objects.
+
+  Projects are keyed by user, project and zone. A project is checked out for
+  the duration of a request, so its http object is never shared between
+  threads, and returned to the pool afterwards so later requests reuse its
+  connections. The least recently used projects are evicted once the pool
+  holds more than max_size idle projects.
+
+  Attributes:
+    max_size: The maximum number of idle projects kept in the pool.
+  """
+
+  def __init__(self, max_size=POOL_SIZE):
+    """Initializes the GceProjectPool class.
+
+    Args:
+      max_size: The maximum number of idle projects kept in the pool.
+    """
+
+    self.max_size = max_size
+    self._idle = collections.OrderedDict()
+    self._size = 0
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def project(self, credentials, user_id, project_id=None, zone_name=None):
+    """Checks out a GceProject for the duration of a with block.
+
+    Args:
+      credentials: An oauth2client.client.Credentials object.
+      user_id: The string id of the user owning the credentials.
+      project_id: A string name for the Compute Engine project.
+      zone_name: The string name of the zone.
+
+    Yields:
+      An authorized GceProject object.
+    """
+
+    gce_project = self.acquire(credentials, user_id, project_id, zone_name)
+    try:
+      yield gce_project
+    finally:
+      self.release(gce_project)
+
+  def acquire(self, credentials, user_id, project_id=None, zone_name=None):
+    """Checks out a GceProject, creating one if none are idle.
+
+    Expired credentials are refreshed first, then bound to the project. A
+    pooled project is rebound whenever the access token differs from the one
+    its service was authorized with, so requests never start with a stale
+    token.
+
+    Args:
+      credentials: An oauth2client.client.Credentials object.
+      user_id: The string id of the user owning the credentials.
+      project_id: A string name for the Compute Engine project.
+      zone_name: The string name of the zone.
+
+    Returns:
+      An authorized GceProject object.
+
+    Raises:
+      GceTokenError: Raised when the access token fails to refresh.
+    """
+
+    if credentials.access_token_expired:
+      try:
+        credentials.refresh(httplib2.Http(timeout=30))
+      except client.AccessTokenRefreshError, e:
+        logging.error(e)
+        raise error.GceTokenError('Access Token refresh error')
+
+    key = (user_id, project_id, zone_name)
+    gce_project = None
+    with self._lock:
+      projects = self._idle.pop(key, None)
+      if projects:
+        gce_project = projects.pop()
+        self._size -= 1
+        if projects:
+          self._idle[key] = projects
+
+    if gce_project:
+      gce_project.set_credentials(credentials)
+    else:
+      gce_project = GceProject(
+          credentials, project_id=project_id, zone_name=zone_name)
+    gce_project._pool_key = key
+    return gce_project
+
+  def release(self, gce_project):
+    """Returns a checked out GceProject to the pool.
+
+    Args:
+      gce_project: A GceProject object returned by acquire.
+    """
+
+    key = gce_project._pool_key
+    with self._lock:
+      # Re-insert the key so it becomes the most recently used.
+      projects = self._idle.pop(key, [])
+      projects.append(gce_project)
+      self._idle[key] = projects
+      self._size += 1
+      while self._size > self.max_size:
+        _, evicted = self._idle.popitem(last=False)
+        self._size -= len(evicted)
+
+
+project_pool = GceProjectPool()
+
+
+def _last_segment(url):
+  """Return the last segment of a resource URL, or None if there is none."""
+  if url:
+    return url.split('/')[-1]
+  return None
+
+
+def _url_project(url):
+  """Return the project of a resource URL, or None if there is none."""
+  segments = (url or '').split('/')
+  if 'projects' in segments[:-1]:
+    return segments[segments.index('projects') + 1]
+  return None
+
+
+def _disk_mount(json_mount):
+  """Return a DiskMount given a dictionary representing it."""
+  mount = DiskMount()
+  mount.from_json(json_mount)
+  return mount
+
+
+class _JsonField(object):
+  """A resource attribute decoded from the resource's JSON on first access.
+
+  The value is kept in a slot of the resource, so it is decoded at most
+  once, and setting the attribute stores the value directly.
+  """
+
+  def __init__(self, slot, decode):
+    """Initializes the _JsonField class.
+
+    Args:
+      slot: The string name of the slot holding the value.
+      decode: A function returning the value given the resource's JSON
+          dictionary.
+    """
+
+    self.slot = slot
+    self.decode = decode
+
+  def __get__(self, resource, resource_class):
+    if resource is None:
+      return self
+    try:
+      return getattr(resource, self.slot)
+    except AttributeError:
+      value = self.decode(resource._json or {})
+      setattr(resource, self.slot, value)
+      return value
+
+  def __set__(self, resource, value):
+    setattr(resource, self.slot, value)
+
+  def __delete__(self, resource):
+    try:
+      delattr(resource, self.slot)
+    except AttributeError:
+      pass
+
+
 class GceResource(object):
   """A GCE resource belonging to a GCE project.
 
+  Resources use __slots__, and resources listed from the API keep the JSON
+  they were listed with and only decode attributes when they are accessed.
+
   Attributes:
     type: The string name of the resource type (ex: instance, firewall).
     scope: The string name of the scope (ex: zonal, global).
+    gce_project: The GceProject the resource belongs to.
   """
 
-  def __init__(self, type, scope):
-    """Initializes the GceResource class.
+  __slots__ = ('gce_project', '_json')
+  type = None
+  scope = None
+
+  def __init__(self):
+    """Initializes the GceResource class."""
+
+    self._json = None
+
+  @classmethod
+  def wrap(cls, json_resource):
+    """Create a resource decoded lazily from a dictionary.
+
+    The constructor isn't called, so no attribute is built until it is
+    accessed.
 
     Args:
-      type: The string name of the resource type (ex: instance, firewall).
-      scope: The string name of the scope (ex: zonal, global).
+      json_resource: A dictionary representing the resource.
+
+    Returns:
+      An object of type cls.
     """
 
-    self.type = type
-    self.scope = scope
+    resource = cls.__new__(cls)
+    resource._json = json_resource
+    return resource
+
+  def from_json(self, json_resource):
+    """Sets member variables from a dictionary representing the resource.
+
+    Attributes are decoded when they are next accessed.
+
+    Args:
+      json_resource: A dictionary representing the resource.
+    """
+
+    self._json = json_resource
+    for attribute in dir(type(self)):
+      if isinstance(getattr(type(self), attribute), _JsonField):
+        delattr(self, attribute)
 
   @property
   def url(self):
@@ -440,6 +1423,8 @@ class DiskMount(object):
     boot: Is this a boot disk?
   """
 
+  __slots__ = ('mount_type', 'mode', 'disk', 'device_name', 'boot')
+
   def __init__(self,
                mount_type='PERSISTENT',
                mode='READ_WRITE',
@@ -488,8 +1473,8 @@ class DiskMount(object):
       self.boot = json_resource['boot']
     if json_resource.get('source'):
       self.disk = Disk(json_resource['source'].split('/')[-1])
-    if json_resource.get('device_name'):
-      self.device_name = json_resource('deviceName')
+    if json_resource.get('deviceName'):
+      self.device_name = json_resource['deviceName']
 
   def set_defaults(self):
     """Set any defaults before insert."""
@@ -520,8 +1505,39 @@ class Instance(GceResource):
     metadata: A list of dictionaries representing the instance's metadata.
     service_accounts: A list of dictionaries representing the instance's
         service accounts.
+    status: The string status of a listed instance.
+    status_message: The string status message of a listed instance.
   """
 
+  __slots__ = ('_name', '_zone', '_description', '_tags', '_image',
+               '_kernel', '_machine_type', '_network_interfaces',
+               '_disk_mounts', '_metadata', '_service_accounts', '_status',
+               '_status_message')
+  type = 'instance'
+  scope = 'zonal'
+
+  name = _JsonField('_name', lambda j: j.get('name'))
+  zone = _JsonField('_zone', lambda j: Zone(_last_segment(j.get('zone'))))
+  description = _JsonField('_description', lambda j: j.get('description'))
+  tags = _JsonField('_tags', lambda j: j.get('tags', {}).get('items'))
+  #BUG: Need to get the project out of the image too
+  image = _JsonField('_image', lambda j: j.get('image') and Image(
+      _last_segment(j['image'])))
+  kernel = _JsonField('_kernel', lambda j: j.get('kernel'))
+  machine_type = _JsonField('_machine_type', lambda j: MachineType(
+      _last_segment(j.get('machineType')), _last_segment(j.get('zone'))))
+  network_interfaces = _JsonField(
+      '_network_interfaces', lambda j: j.get('networkInterfaces'))
+  disk_mounts = _JsonField('_disk_mounts', lambda j: [
+      _disk_mount(m) for m in j.get('disks', [])])
+  metadata = _JsonField(
+      '_metadata', lambda j: j.get('metadata', {}).get('items'))
+  service_accounts = _JsonField(
+      '_service_accounts', lambda j: j.get('serviceAccounts'))
+  status = _JsonField('_status', lambda j: j.get('status'))
+  status_message = _JsonField(
+      '_status_message', lambda j: j.get('statusMessage'))
+
   def __init__(self,
                name=None,
                zone_name=None,
@@ -554,7 +1570,7 @@ class Instance(GceResource):
           service accounts.
     """
 
-    super(Instance, self).__init__('instance', 'zonal')
+    super(Instance, self).__init__()
     self.name = name
     self.zone = Zone(zone_name)
     self.description = description
@@ -599,45 +1615,6 @@ class Instance(GceResource):
       instance['serviceAccounts'] = self.service_accounts
     return instance
 
-  def from_json(self, json_resource):
-    """Sets member variables from a dictionary representing an instance.
-
-    Args:
-      json_resource: A dictionary representing the instance.
-    """
-
-    self.name = json_resource['name']
-    self.zone_name = Zone(json_resource['zone'].split('/')[-1])
-    self.machine_type = MachineType(json_resource['machineType'].split('/')[-1],
-                                    self.zone_name)
-    self.network_interfaces = json_resource['networkInterfaces']
-    if json_resource.get('description', None):
-      self.description = json_resource['description']
-    if json_resource.get('tags', None):
-      if json_resource['tags'].get('items', None):
-        self.tags = json_resource['tags']['items']
-    if json_resource.get('image', None):
-      #BUG: Need to get the zone out of the image too
-      self.image = Image(json_resource['image'].split('/')[-1])
-    if json_resource.get('kernel', None):
-      self.kernel = json_resource['kernel']
-    if json_resource.get('status', None):
-      self.status = json_resource['status']
-    if json_resource.get('statusMessage', None):
-      self.status_message = json_resource['statusMessage']
-    if json_resource.get('disks', None):
-      self.disk_mounts = []
-      json_mounts = json_resource['disks']
-      for jm in json_mounts:
-        m = DiskMount()
-        m.from_json(jm)
-        self.disk_mounts.append(m)
-    if json_resource.get('metadata', None):
-      if json_resource['metadata'].get('items', None):
-        self.metadata = json_resource['metadata']['items']
-    if json_resource.get('serviceAccounts', None):
-      self.service_accounts = json_resource['serviceAccounts']
-
   def set_defaults(self):
     """Set any defaults before insert."""
 
@@ -685,6 +1662,134 @@ class Instance(GceResource):
     return self.gce_project.service.instances()
 
 
+class InstanceTemplate(object):
+  """Shared settings for inserting many similar instances.
+
+  The zone, machine type, network, image and disk URLs of the template are
+  resolved once per GceProject, and stamp returns instances whose request
+  body is a copy of the resolved one with only the per-instance fields
+  swapped in.
+
+  Attributes:
+    instance: The Instance holding the shared settings.
+  """
+
+  def __init__(self, **kwargs):
+    """Initializes the InstanceTemplate class.
+
+    Args:
+      **kwargs: The shared settings, as keyword arguments to Instance.
+    """
+
+    self.instance = Instance(**kwargs)
+    self._gce_project = None
+    self._body = None
+
+  def stamp(self, name, metadata=None, disk_mounts=None):
+    """Create an instance from the template.
+
+    Args:
+      name: The string name of the instance.
+      metadata: A list of metadata items added to the template's.
+      disk_mounts: A list of DiskMount objects used instead of the
+          template's.
+
+    Returns:
+      A TemplateInstance object.
+    """
+
+    return TemplateInstance(self, name, metadata, disk_mounts)
+
+  def resolve(self, gce_project):
+    """Return the request body shared by the instances of the template.
+
+    Args:
+      gce_project: The GceProject the instances are inserted in.
+
+    Returns:
+      A dictionary representing the shared fields of the instances. It must
+      not be modified.
+    """
+
+    if self._body is None or self._gce_project is not gce_project:
+      self.instance.gce_project = gce_project
+      self.instance.set_defaults()
+      body = self.instance.json
+      del body['name']
+      self._gce_project = gce_project
+      self._body = body
+    return self._body
+
+
+class TemplateInstance(GceResource):
+  """An Instance resource stamped out of an InstanceTemplate.
+
+  Attributes:
+    template: The InstanceTemplate of the instance.
+    name: The string name of the instance.
+    metadata: A list of metadata items added to the template's.
+    disk_mounts: A list of DiskMount objects used instead of the template's.
+  """
+
+  type = 'instance'
+  scope = 'zonal'
+
+  def __init__(self, template, name, metadata=None, disk_mounts=None):
+    """Initializes the TemplateInstance class.
+
+    Args:
+      template: The InstanceTemplate of the instance.
+      name: The string name of the instance.
+      metadata: A list of metadata items added to the template's.
+      disk_mounts: A list of DiskMount objects used instead of the
+          template's.
+    """
+
+    super(TemplateInstance, self).__init__()
+    self.template = template
+    self.name = name
+    self.metadata = metadata
+    self.disk_mounts = disk_mounts
+    self._body = None
+
+  @property
+  def json(self):
+    """Create a json representation of the resource.
+
+    Returns:
+      A dictionary representing the resource.
+    """
+
+    instance = dict(self._body)
+    instance['name'] = self.name
+    if self.metadata:
+      items = self.template.instance.metadata or []
+      instance['metadata'] = {'items': items + self.metadata}
+    if self.disk_mounts:
+      instance['disks'] = [m.json for m in self.disk_mounts]
+      # Instances booting from a persistent disk don't take an image.
+      if [m for m in self.disk_mounts if m.boot]:
+        instance.pop('image', None)
+    return instance
+
+  def set_defaults(self):
+    """Set any defaults before insert."""
+
+    self._body = self.template.resolve(self.gce_project)
+    for d in self.disk_mounts or []:
+      d.set_gce_project(self.gce_project)
+      d.set_defaults()
+
+  def service_resource(self):
+    """Return the instances method of the apiclient.discovery.Resource object.
+
+    Returns:
+      The instances method of the apiclient.discovery.Resource object.
+    """
+
+    return self.gce_project.service.instances()
+
+
 class Firewall(GceResource):
   """A class representing a GCE Firewall resource.
 
@@ -702,6 +1807,21 @@ class Firewall(GceResource):
       and open ports.
   """
 
+  __slots__ = ('_name', '_description', '_network', '_source_ranges',
+               '_source_tags', '_target_tags', '_allowed')
+  type = 'firewall'
+  scope = 'global'
+
+  name = _JsonField('_name', lambda j: j.get('name'))
+  description = _JsonField('_description', lambda j: j.get('description'))
+  network = _JsonField(
+      '_network', lambda j: Network(_last_segment(j.get('network'))))
+  source_ranges = _JsonField(
+      '_source_ranges', lambda j: j.get('sourceRanges'))
+  source_tags = _JsonField('_source_tags', lambda j: j.get('sourceTags'))
+  target_tags = _JsonField('_target_tags', lambda j: j.get('targetTags'))
+  allowed = _JsonField('_allowed', lambda j: j.get('allowed'))
+
   def __init__(self,
                name=None,
                description=None,
@@ -726,7 +1846,7 @@ class Firewall(GceResource):
         and open ports.
     """
 
-    super(Firewall, self).__init__('firewall', 'global')
+    super(Firewall, self).__init__()
     self.name = name
     self.description = description
     self.network = Network(network_name)
@@ -756,23 +1876,6 @@ class Firewall(GceResource):
       firewall['targetTags'] = self.target_tags
     return firewall
 
-  def from_json(self, json_resource):
-    """Sets member variables from a dictionary representing a firewall.
-
-    Args:
-      json_resource: A dictionary representing the firewall.
-    """
-
-    self.name = json_resource['name']
-    self.network = json_resource['network']
-    self.allowed = json_resource['allowed']
-    if json_resource.get('sourceRanges', None):
-      self.source_ranges = json_resource['sourceRanges']
-    if json_resource.get('sourceTags', None):
-      self.source_tags = json_resource['sourceTags']
-    if json_resource.get('targetTags', None):
-      self.source_tags = json_resource['targetTags']
-
   def set_defaults(self):
     """Set any defaults before insert."""
 
@@ -809,6 +1912,20 @@ class Image(GceResource):
     raw_disk: A dictionary representing the raw disk.
   """
 
+  __slots__ = ('_name', '_project_id', '_description', '_source_type',
+               '_preferred_kernel', '_raw_disk')
+  type = 'image'
+  scope = 'global'
+
+  name = _JsonField('_name', lambda j: j.get('name'))
+  project_id = _JsonField('_project_id', lambda j: _url_project(
+      j.get('selfLink')) or GOOGLE_PROJECT)
+  description = _JsonField('_description', lambda j: j.get('description'))
+  source_type = _JsonField('_source_type', lambda j: j.get('sourceType'))
+  preferred_kernel = _JsonField(
+      '_preferred_kernel', lambda j: j.get('preferredKernel'))
+  raw_disk = _JsonField('_raw_disk', lambda j: j.get('rawDisk'))
+
   def __init__(self,
                name=None,
                project_id=GOOGLE_PROJECT,
@@ -827,7 +1944,7 @@ class Image(GceResource):
       raw_disk: A dictionary representing the raw disk.
     """
 
-    super(Image, self).__init__('image', 'global')
+    super(Image, self).__init__()
     self.name = name
     self.project_id = project_id
     self.description = description
@@ -855,23 +1972,6 @@ class Image(GceResource):
     if self.raw_disk:
       image['rawDisk'] = self.raw_disk
 
-  def from_json(self, json_resource):
-    """Sets member variables from a dictionary representing a image.
-
-    Args:
-      json_resource: A dictionary representing the image.
-    """
-
-    self.name = json_resource['name']
-    if json_resource.get('description', None):
-      self.description = json_resource['description']
-    if json_resource.get('sourceType', None):
-      self.source_type = json_resource['sourceType']
-    if json_resource.get('preferredKernel', None):
-      self.preferred_kernel = json_resource['preferredKernel']
-    if json_resource.get('rawDisk', None):
-      self.raw_disk = json_resource['rawDisk']
-
   def service_resource(self):
     """Return the images method of the apiclient.discovery.Resource object.
 
@@ -892,6 +1992,15 @@ class Disk(GceResource):
     size_gb: The size of the disk in GB
   """
 
+  __slots__ = ('_name', '_zone', '_description', '_size_gb')
+  type = 'disk'
+  scope = 'zonal'
+
+  name = _JsonField('_name', lambda j: j.get('name'))
+  zone = _JsonField('_zone', lambda j: Zone(_last_segment(j.get('zone'))))
+  description = _JsonField('_description', lambda j: j.get('description'))
+  size_gb = _JsonField('_size_gb', lambda j: j.get('sizeGb'))
+
   def __init__(self,
                name=None,
                zone_name=None,
@@ -906,7 +2015,7 @@ class Disk(GceResource):
       size_gb: The size of the disk in GB
     """
 
-    super(Disk, self).__init__('disk', 'zonal')
+    super(Disk, self).__init__()
     self.name = name
     self.zone = Zone(zone_name)
     self.description = description
@@ -929,19 +2038,6 @@ class Disk(GceResource):
       instance['sizeGb'] = self.size_gb
     return disk
 
-  def from_json(self, json_resource):
-    """Sets member variables from a dictionary representing a disk.
-
-    Args:
-      json_resource: A dictionary representing the disk.
-    """
-
-    self.name = json_resource['name']
-    self.zone = Zone(json_resource['zone'].split('/')[-1])
-    self.size_gb = json_resource['sizeGb']
-    if json_resource.get('description', None):
-      self.description = json_resource['description']
-
   def set_defaults(self):
     """Set any defaults before insert."""
     self.zone.gce_project = self.gce_project
@@ -965,6 +2061,10 @@ class MachineType(GceResource):
     name: The string name of the machine type.
   """
 
+  __slots__ = ('name', 'zone')
+  type = 'machineType'
+  scope = 'zonal'
+
   def __init__(self, name=None, zone_name=None):
     """Initialize the MachineType class.
 
@@ -972,7 +2072,7 @@ class MachineType(GceResource):
       name: The string name of the machine type.
     """
 
-    super(MachineType, self).__init__('machineType', 'zonal')
+    super(MachineType, self).__init__()
     self.name = name
     self.zone = Zone(zone_name)
 
@@ -1000,6 +2100,10 @@ class Zone(GceResource):
     name: The string name of the zone.
   """
 
+  __slots__ = ('name',)
+  type = 'zone'
+  scope = 'global'
+
   def __init__(self, name=None):
     """Initialize the Zone class.
 
@@ -1007,7 +2111,7 @@ class Zone(GceResource):
       name: The string name of the zone.
     """
 
-    super(Zone, self).__init__('zone', 'global')
+    super(Zone, self).__init__()
     self.name = name
 
   def service_resource(self):
@@ -1027,6 +2131,10 @@ class Network(GceResource):
     name: The string name of the network.
   """
 
+  __slots__ = ('name',)
+  type = 'network'
+  scope = 'global'
+
   def __init__(self, name=None):
     """Initialize the Network class.
 
@@ -1034,7 +2142,7 @@ class Network(GceResource):
       name: The string name of the network.
     """
 
-    super(Network, self).__init__('network', 'global')
+    super(Network, self).__init__()
     self.name = name
 
   def service_resource(self):
@@ -14,12 +14,562 @@
 
 """GCE App Engine Helper class."""
 
+import abc
 import json
 import logging
+import time
 
+import gce
 import gce_exception as error
+import oauth2client.appengine as oauth2client
+
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 
 MAX_RESULTS = 100
+INVENTORY_TTL = 10
+CAS_RETRIES = 3
+# The instance fields InstanceInventory records, for list projections.
+INVENTORY_FIELDS = ('name', 'status', 'networkInterfaces/accessConfigs/natIP')
+# Seconds between the reconcile passes of a cluster that is changing, the
+# first delay after a failed pass (doubled on each failure), and the number
+# of passes after which the controller gives up on a version.
+RECONCILE_CHECK_DELAY = 10
+RECONCILE_RETRY_DELAY = 5
+RECONCILE_MAX_PASSES = 20
+# Statuses of instances on their way out, which reconciling neither counts
+# nor deletes again.
+STOPPED_STATUSES = frozenset(['STOPPING', 'TERMINATED'])
+
+
+def cluster_filter(prefix):
+  """Return the list filter matching the instances of a cluster.
+
+  Cluster instances are named <prefix>-<number>, so the filter doesn't match
+  the instances of clusters whose prefix starts with this one.
+
+  Args:
+    prefix: The string prefix of the cluster's instance names.
+
+  Returns:
+    The string filter for GceProject.list_instances.
+  """
+
+  return r'name eq ^%s-\d+$' % prefix
+
+
+class InstanceInventory(object):
+  """A short-lived, write-through memcache mirror of a demo's instances.
+
+  The inventory stores a snapshot of instance name, status and external IP
+  for the instances whose names start with a prefix, along with the
+  operations started on them since they were listed. Inserts and deletes
+  update the snapshot as they are sent, and pending operations are polled
+  with a single batch request when the snapshot is read.
+
+  Snapshots are stored under a key carrying a version number that is shared
+  by all prefixes in the project and zone, so invalidate() drops them all.
+
+  Attributes:
+    gce_project: An object of type gce.GceProject.
+    prefix: The string prefix of the instance names.
+  """
+
+  def __init__(self, gce_project, prefix):
+    """Initializes the InstanceInventory class.
+
+    Args:
+      gce_project: An object of type gce.GceProject.
+      prefix: The string prefix of the instance names.
+    """
+
+    self.gce_project = gce_project
+    self.prefix = prefix
+    self._version_key = 'inventory-version:%s:%s' % (
+        gce_project.project_id, gce_project.zone_name)
+
+  def get(self):
+    """Returns the cached snapshot, after polling its pending operations.
+
+    Returns:
+      A dictionary of instance name -> dictionary with the instance status
+      and, if known, its externalIp. None if nothing is cached.
+    """
+
+    snapshot = memcache.get(self._key())
+    if snapshot is None:
+      return None
+    if not snapshot['operations']:
+      return snapshot['instances']
+
+    tracker = gce.OperationTracker(self.gce_project)
+    for operation in snapshot['operations']:
+      tracker.add(operation)
+    try:
+      tracker.poll()
+    except (error.GceError, error.GceTokenError), e:
+      logging.warning('Error polling operations: %s', e)
+      return snapshot['instances']
+
+    done = [operation for operation in tracker.operations.values()
+            if operation.get('status') == 'DONE']
+    if not done:
+      return snapshot['instances']
+    if [operation for operation in done
+        if operation.get('operationType') != 'delete']:
+      # The status and IP of new instances is only known from a listing.
+      self.invalidate()
+      return None
+
+    done_names = set(operation['name'] for operation in done)
+
+    def remove_deleted(snapshot):
+      for operation in done:
+        snapshot['instances'].pop(self._target_name(operation), None)
+      snapshot['operations'] = [
+          operation for operation in snapshot['operations']
+          if operation['name'] not in done_names]
+    return self._update(remove_deleted)
+
+  def refresh(self, instances):
+    """Replaces the snapshot with a new listing.
+
+    Args:
+      instances: A list of gce.Instance objects.
+
+    Returns:
+      A dictionary of instance name -> dictionary with the instance status
+      and, if known, its externalIp.
+    """
+
+    instance_dict = {}
+    for instance in instances:
+      instance_dict[instance.name] = self._record(instance)
+    memcache.set(self._key(),
+                 {'instances': instance_dict, 'operations': []},
+                 time=INVENTORY_TTL)
+    return instance_dict
+
+  def record_results(self, batch_results, status):
+    """Writes the outcome of a bulk insert or delete to the snapshot.
+
+    Args:
+      batch_results: A list of gce.BatchResult objects.
+      status: The string status to set on instances with a successful
+          request, ex: PROVISIONING or STOPPING.
+    """
+
+    operations = [result.operation for result in batch_results
+                  if result.operation]
+    if not operations:
+      return
+
+    def add_operations(snapshot):
+      for operation in operations:
+        snapshot['instances'][self._target_name(operation)] = {
+            'status': status}
+      snapshot['operations'].extend(operations)
+    self._update(add_operations)
+
+  def invalidate(self):
+    """Drops the snapshots of all prefixes in the project and zone."""
+
+    memcache.incr(self._version_key, initial_value=0)
+
+  def _key(self):
+    """Returns the memcache key of the current snapshot."""
+
+    version = memcache.get(self._version_key) or 0
+    return 'inventory:%s:%s:%s:%d' % (
+        self.gce_project.project_id, self.gce_project.zone_name, self.prefix,
+        version)
+
+  def _update(self, function):
+    """Applies a change to the cached snapshot using compare-and-set.
+
+    Nothing is written if no snapshot is cached, since the next read lists
+    the instances anyway. If the snapshot keeps changing underneath, it is
+    invalidated.
+
+    Args:
+      function: A function that modifies a snapshot dictionary in place.
+
+    Returns:
+      The updated dictionary of instance name -> instance record, or None.
+    """
+
+    client = memcache.Client()
+    key = self._key()
+    for _ in xrange(CAS_RETRIES):
+      snapshot = client.gets(key)
+      if snapshot is None:
+        return None
+      function(snapshot)
+      if client.cas(key, snapshot, time=INVENTORY_TTL):
+        return snapshot['instances']
+    self.invalidate()
+    return None
+
+  def _record(self, instance):
+    """Returns the cached record for an instance.
+
+    Args:
+      instance: A gce.Instance object.
+
+    Returns:
+      A dictionary with the instance status and, if known, its externalIp.
+    """
+
+    record = {'status': getattr(instance, 'status', None) or 'OTHER'}
+    for interface in instance.network_interfaces or []:
+      for config in interface.get('accessConfigs', []):
+        if 'natIP' in config:
+          record['externalIp'] = config['natIP']
+          return record
+    return record
+
+  def _target_name(self, operation):
+    """Returns the name of the instance an operation applies to."""
+
+    return operation['targetLink'].split('/')[-1]
+
+
+class ClusterObjective(ndb.Model):
+  """The desired state of a demo cluster.
+
+  Entities are keyed by project, zone and instance name prefix. Every
+  change of the target bumps the version, and the ClusterController
+  reconciles the latest version in the background.
+  """
+  # Disable caching of objective.
+  _use_memcache = False
+  _use_cache = False
+
+  # The user whose credentials are used to reconcile the cluster.
+  user_id = ndb.StringProperty()
+
+  project_id = ndb.StringProperty()
+  zone_name = ndb.StringProperty()
+  prefix = ndb.StringProperty()
+
+  # Desired number of VMs. This will be >0 for a start request or 0 for a
+  # reset/stop request.
+  target_instances = ndb.IntegerProperty(default=0)
+
+  # Number of VMs requested by the last start request. This is handy when
+  # recovering during a reset operation, so we can figure out how many
+  # instances to depict in the UI.
+  started_instances = ndb.IntegerProperty(default=0)
+
+  # Demo specific values the ClusterSpec needs to build the instances.
+  parameters = ndb.JsonProperty()
+
+  # Epoch time when last/current request was started.
+  start_time = ndb.IntegerProperty()
+
+  version = ndb.IntegerProperty(default=0)
+  converged_version = ndb.IntegerProperty(default=0)
+
+  # The last reconcile error, if the latest version hasn't converged.
+  error = ndb.TextProperty()
+
+  @property
+  def status(self):
+    """A dictionary describing the objective, for JSON responses."""
+    return {
+      'version': self.version,
+      'convergedVersion': self.converged_version,
+      'targetInstances': self.target_instances,
+      'startTime': self.start_time,
+      'error': self.error,
+    }
+
+
+class ClusterSpec(object):
+  """Describes the instances a demo cluster should have.
+
+  Demos subclass it. The spec is pickled into the reconcile tasks, so it
+  should hold no state.
+  """
+
+  __metaclass__ = abc.ABCMeta
+
+  def get_queries(self, objective):
+    """Return the listings build_instances needs.
+
+    They are fetched in the same batch request as the cluster's instances.
+
+    Args:
+      objective: The ClusterObjective being reconciled.
+
+    Returns:
+      A dictionary of key -> (resource class, list arguments), see
+      gce.GceProject.list_batch.
+    """
+    return {}
+
+  @abc.abstractmethod
+  def build_instances(self, gce_project, objective, listings):
+    """Return the instances the cluster should have.
+
+    Args:
+      gce_project: An instance of gce.GceProject.
+      objective: The ClusterObjective being reconciled.
+      listings: A dictionary of key -> list of resources for the queries
+          returned by get_queries.
+
+    Returns:
+      A list of the instance resources to insert if missing.
+
+    Raises:
+      GceError: Raised when an API call fails.
+      GceTokenError: Raised when the access token fails to refresh.
+    """
+
+
+class ClusterController(object):
+  """Converges a demo cluster to its ClusterObjective in the background.
+
+  set_target records a new version of the objective and starts a chain of
+  deferred reconcile passes. Each pass lists the cluster, diffs it against
+  the instances of the spec, and sends the inserts and deletes in batches.
+  The chain continues until a pass finds nothing to change, a newer version
+  is set, or RECONCILE_MAX_PASSES passes were made.
+
+  Attributes:
+    project_id: The string name of the Compute Engine project.
+    zone_name: The string name of the zone.
+    prefix: The string prefix of the cluster's instance names.
+    spec: The ClusterSpec of the cluster.
+  """
+
+  def __init__(self, project_id, zone_name, prefix, spec):
+    """Initializes the ClusterController class.
+
+    Args:
+      project_id: The string name of the Compute Engine project.
+      zone_name: The string name of the zone.
+      prefix: The string prefix of the cluster's instance names.
+      spec: The ClusterSpec of the cluster.
+    """
+
+    self.project_id = project_id
+    self.zone_name = zone_name
+    self.prefix = prefix
+    self.spec = spec
+
+  def get(self):
+    """Return the cluster's ClusterObjective, or None if there is none."""
+
+    return self._key().get()
+
+  def set_target(self, user_id, target_instances, parameters=None):
+    """Records a new desired state and starts reconciling it.
+
+    Args:
+      user_id: The string id of the user whose credentials are used.
+      target_instances: The desired number of instances.
+      parameters: A dictionary of values the spec uses, if any.
+
+    Returns:
+      The ClusterObjective holding the new version.
+    """
+
+    @ndb.transactional
+    def update():
+      objective = self.get()
+      if not objective:
+        objective = ClusterObjective(
+            key=self._key(), project_id=self.project_id,
+            zone_name=self.zone_name, prefix=self.prefix)
+      objective.user_id = user_id
+      objective.target_instances = target_instances
+      # Overwrite started_instances only when starting, skip when stopping.
+      if target_instances > 0:
+        objective.started_instances = target_instances
+      if parameters is not None:
+        objective.parameters = parameters
+      objective.start_time = int(time.time())
+      objective.version += 1
+      objective.error = None
+      objective.put()
+      deferred.defer(reconcile_cluster, self, objective.version,
+                     _transactional=True)
+      return objective
+
+    return update()
+
+  def adopt(self, user_id, target_instances, started_instances, start_time):
+    """Records the state of a cluster started before it had an objective.
+
+    Unlike set_target, nothing is reconciled: the objective is recorded as
+    converged, since the instances were already started or stopped.
+
+    Args:
+      user_id: The string id of the user whose credentials are used.
+      target_instances: The desired number of instances.
+      started_instances: The number of instances of the last start request.
+      start_time: The epoch time of the last request.
+
+    Returns:
+      The ClusterObjective, the existing one if the cluster has one.
+    """
+
+    @ndb.transactional
+    def adopt():
+      objective = self.get()
+      if objective:
+        return objective
+      objective = ClusterObjective(
+          key=self._key(), user_id=user_id, project_id=self.project_id,
+          zone_name=self.zone_name, prefix=self.prefix,
+          target_instances=target_instances,
+          started_instances=started_instances, start_time=start_time,
+          version=1, converged_version=1)
+      objective.put()
+      return objective
+
+    return adopt()
+
+  def reconcile(self, version, passes=0):
+    """Runs a reconcile pass and schedules the next one if needed.
+
+    Args:
+      version: The int version of the objective to converge to.
+      passes: The number of passes already made for the version.
+
+    Raises:
+      PermanentTaskFailure: Raised when the user has no valid credentials,
+          which is recorded on the objective.
+    """
+
+    objective = self.get()
+    if not objective or objective.version != version:
+      logging.info('Objective %s of %s superseded', version, self.prefix)
+      return
+
+    credentials = oauth2client.StorageByKeyName(
+        oauth2client.CredentialsModel, objective.user_id,
+        'credentials').get()
+    if not credentials or credentials.invalid:
+      # Retrying can't help until the user authorizes the app again.
+      message = 'No valid credentials for user %s.' % objective.user_id
+      logging.error('Error reconciling %s: %s', self.prefix, message)
+      self._update(version, message=message)
+      raise deferred.PermanentTaskFailure(message)
+    try:
+      with gce.project_pool.project(
+          credentials, objective.user_id, project_id=self.project_id,
+          zone_name=self.zone_name) as gce_project:
+        changed, errors = self._converge(gce_project, objective)
+    except (error.GceError, error.GceTokenError), e:
+      changed, errors = True, [e]
+
+    if not changed and not errors:
+      self._update(version, converged=True)
+      return
+
+    message = None
+    delay = RECONCILE_CHECK_DELAY
+    if errors:
+      message = '; '.join(str(e) for e in errors)
+      logging.error('Error reconciling %s: %s', self.prefix, message)
+      delay = RECONCILE_RETRY_DELAY * 2 ** min(passes, 6)
+    if passes + 1 >= RECONCILE_MAX_PASSES:
+      self._update(version, message=message or 'Cluster did not converge.')
+      return
+    if message:
+      self._update(version, message=message)
+    deferred.defer(reconcile_cluster, self, version, passes + 1,
+                   _countdown=delay)
+
+  def _converge(self, gce_project, objective):
+    """Inserts the missing instances and deletes the extra ones.
+
+    Args:
+      gce_project: An instance of gce.GceProject.
+      objective: The ClusterObjective to converge to.
+
+    Returns:
+      A tuple with whether anything had to change or is waiting on a
+      delete, and a list of the errors of the inserts and deletes.
+
+    Raises:
+      GceError: Raised when an API call fails.
+      GceTokenError: Raised when the access token fails to refresh.
+    """
+
+    queries = dict(self.spec.get_queries(objective))
+    queries['instances'] = (gce.Instance, {
+      'filter': cluster_filter(self.prefix),
+      'projection': INVENTORY_FIELDS,
+    })
+    listings = gce_project.list_batch(queries)
+    target = self.spec.build_instances(gce_project, objective, listings)
+    listed = listings['instances']
+
+    inventory = InstanceInventory(gce_project, self.prefix)
+    inventory.refresh(listed)
+
+    # Instances being deleted still hold their names, so the target
+    # instances named like them wait for a later pass.
+    current = [i for i in listed if i.status not in STOPPED_STATUSES]
+    stopped_names = set(i.name for i in listed
+                        if i.status in STOPPED_STATUSES)
+    target_names = set(instance.name for instance in target)
+    current_names = set(instance.name for instance in current)
+    to_add = [i for i in target
+              if i.name not in current_names and i.name not in stopped_names]
+    waiting = [i for i in target if i.name in stopped_names]
+    to_remove = [i for i in current if i.name not in target_names]
+    logging.info('Reconciling %s: adding %s, removing %s', self.prefix,
+                 [i.name for i in to_add], [i.name for i in to_remove])
+
+    errors = []
+    if to_add:
+      results = gce_project.bulk_insert(to_add)
+      inventory.record_results(results, 'PROVISIONING')
+      errors.extend(r.error for r in results if r.error)
+    if to_remove:
+      results = gce_project.bulk_delete(to_remove)
+      inventory.record_results(results, 'STOPPING')
+      errors.extend(r.error for r in results if r.error)
+    return bool(to_add or to_remove or waiting), errors
+
+  def _update(self, version, converged=False, message=None):
+    """Records the outcome of a pass if the version is still current."""
+
+    @ndb.transactional
+    def update():
+      objective = self.get()
+      if not objective or objective.version != version:
+        return
+      if converged:
+        objective.converged_version = version
+      objective.error = message
+      objective.put()
+
+    update()
+
+  def _key(self):
+    """Return the ndb.Key of the cluster's ClusterObjective."""
+
+    return ndb.Key(ClusterObjective, '%s:%s:%s' % (
+        self.project_id, self.zone_name, self.prefix))
+
+
+def reconcile_cluster(controller, version, passes=0):
+  """Deferred task running a reconcile pass of a cluster.
+
+  Args:
+    controller: The ClusterController of the cluster.
+    version: The int version of the objective to converge to.
+    passes: The number of passes already made for the version.
+  """
+
+  controller.reconcile(version, passes)
+
 
 class GceAppEngine(object):
   """Contains generic GCE methods for demos."""
@@ -28,7 +578,9 @@ class GceAppEngine(object):
     """Retrieves instance list for the demo.
 
     Sends the instance list in the response as a JSON object, mapping instance
-    name to status.
+    name to status. The list is read from the demo's InstanceInventory when
+    cached. Otherwise the instances are listed with cluster_filter, like
+    every other refresh of the inventory, and the inventory is refreshed.
 
     Args:
       request_handler: An instance of webapp2.RequestHandler.
@@ -36,28 +588,40 @@ class GceAppEngine(object):
       demo_name: The string name of the demo.
     """
 
+    response = request_handler.response
+    inventory = InstanceInventory(gce_project, demo_name)
+    instance_dict = inventory.get()
+    if instance_dict is not None:
+      result_dict = {'instances': {}}
+      for name, record in instance_dict.items():
+        result_dict['instances'][name] = {'status': record['status']}
+      response.headers['Content-Type'] = 'application/json'
+      response.out.write(json.dumps(result_dict))
+      return
+
     instances = self.run_gce_request(
         request_handler,
         gce_project.list_instances,
         'Error listing instances: ',
-        filter='name eq ^%s.*' % demo_name,
-        maxResults=MAX_RESULTS)
+        filter=cluster_filter(demo_name),
+        maxResults=MAX_RESULTS,
+        projection=INVENTORY_FIELDS)
+    if instances is None:
+      return
 
-    instance_dict = {}
+    result_dict = {'instances': {}}
     for instance in instances:
-      instance_dict[instance.name] = {'status': instance.status}
-
-    result_dict = {
-      'instances': instance_dict,
-    }
-    request_handler.response.headers['Content-Type'] = 'application/json'
-    request_handler.response.out.write(json.dumps(result_dict))
+      result_dict['instances'][instance.name] = {'status': instance.status}
+    response.headers['Content-Type'] = 'application/json'
+    response.out.write(json.dumps(result_dict))
+    inventory.refresh(instances)
 
   def delete_demo_instances(self, request_handler, gce_project, demo_name):
     """Deletes instances for the demo.
 
-    First retrieves an instance list with instance names starting with the
-    demo name. A bulk request is then sent to delete all these instances.
+    First retrieves the list of the demo's instances, see cluster_filter. A
+    bulk request is then sent to delete all these instances, and the demo's
+    InstanceInventory is updated.
 
     Args:
       request_handler: An instance of webapp2.RequestHandler.
@@ -69,8 +633,9 @@ class GceAppEngine(object):
         request_handler,
         gce_project.list_instances,
         'Error listing instances: ',
-        filter='name eq ^%s-.*' % demo_name,
-        maxResults=MAX_RESULTS)
+        filter=cluster_filter(demo_name),
+        maxResults=MAX_RESULTS,
+        projection=('name',))
 
     if instances:
       response = self.run_gce_request(
@@ -80,8 +645,10 @@ class GceAppEngine(object):
           resources=instances)
 
       if response:
-        self.response.headers['Content-Type'] = 'text/plain'
-        self.response.out.write('stopping cluster')
+        InstanceInventory(gce_project, demo_name).record_results(
+            response, 'STOPPING')
+        request_handler.response.headers['Content-Type'] = 'text/plain'
+        request_handler.response.out.write('stopping cluster')
 
   def run_gce_request(self, request_handler, gce_method, error_message, **args):
     """Run a GCE Project list, insert, delete method.
@@ -16,6 +16,11 @@
 
 __author__ = 'kbrisbin@google.com (Kathryn Hurley)'
 
+# HTTP statuses and API error reasons for errors that are worth retrying.
+RETRYABLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+RETRYABLE_REASONS = frozenset(
+    ['rateLimitExceeded', 'userRateLimitExceeded', 'backendError'])
+
 
 class GcelibError(Exception):
   """Gcelib Error raised when there's an API error."""
@@ -26,6 +31,29 @@ class GceError(Exception):
   """GceError raised during improper use of the GceAppEngineHelper class."""
   pass
 
+
+class GceRetryableError(GceError):
+  """GceError raised for transient API errors that can be retried."""
+  pass
+
+
 class GceTokenError(Exception):
   """Error raised when there's an issue refreshing the access token."""
   pass
+
+
+def api_error(status, reason, message):
+  """Creates the exception for an API error response.
+
+  Args:
+    status: The integer HTTP status of the response.
+    reason: The string reason of the first error in the response, if any.
+    message: The string error message.
+
+  Returns:
+    A GceRetryableError if the error is transient, a GceError otherwise.
+  """
+
+  if status in RETRYABLE_STATUSES or reason in RETRYABLE_REASONS:
+    return GceRetryableError(message)
+  return GceError(message)
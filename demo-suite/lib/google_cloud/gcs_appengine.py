@@ -16,10 +16,104 @@
 
 __author__ = 'kbrisbin@google.com (Kathryn Hurley)'
 
+import hashlib
+import logging
+import time
+
 import cs
+import httplib2
 import lib_path
+import oauth2client.appengine as oauth2client
+import oauth2client.client as client
 
+from google.appengine.api import taskqueue
 from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+# The delimiter splitting a cleanup into one shard per 'directory'.
+CLEANUP_DELIMITER = '/'
+# The number of delete errors a cleanup shard keeps for its progress.
+CLEANUP_ERROR_SAMPLE = 20
+
+
+class CleanupJob(ndb.Model):
+  """A cleanup of the objects of a bucket and directory.
+
+  The cleanup runs as deferred tasks, one CleanupShard per common prefix
+  below the directory. The user's stored credentials are loaded by each
+  task, so a long cleanup isn't bound to a single access token.
+  """
+  # Disable caching of the job.
+  _use_memcache = False
+  _use_cache = False
+
+  # The user whose credentials are used to list and delete.
+  user_id = ndb.StringProperty()
+  project_id = ndb.StringProperty()
+  bucket = ndb.StringProperty()
+  directory = ndb.StringProperty()
+  file_regex = ndb.StringProperty()
+
+  # Epoch time when the cleanup was started.
+  start_time = ndb.IntegerProperty()
+
+  @property
+  def status(self):
+    """A dictionary with the progress of the job, for JSON responses.
+
+    The counts are summed over the job's shards, so they may lag the
+    tasks by a few seconds.
+    """
+    shards = CleanupShard.query(CleanupShard.job_id == self.key.id()).fetch()
+    errors = {}
+    for shard in shards:
+      errors.update(shard.errors or {})
+      if shard.error:
+        errors[shard.prefix] = shard.error
+    return {
+      'id': self.key.id(),
+      'bucket': self.bucket,
+      'directory': self.directory,
+      'startTime': self.start_time,
+      'shards': len(shards),
+      'shardsDone': sum(1 for shard in shards if shard.done),
+      'pages': sum(shard.pages for shard in shards),
+      'deleted': sum(shard.deleted for shard in shards),
+      'failed': sum(shard.failed for shard in shards),
+      'done': bool(shards) and all(shard.done for shard in shards),
+      'errors': errors,
+    }
+
+
+class CleanupShard(ndb.Model):
+  """The checkpoint of the cleanup of one prefix of a CleanupJob.
+
+  Each task processes one listing page of the prefix, then records the
+  marker of the next page here before chaining the task for it. A task
+  that is retried, or restarted after a failure, resumes from the last
+  recorded marker; deleting an object twice is harmless.
+  """
+  _use_memcache = False
+  _use_cache = False
+
+  job_id = ndb.IntegerProperty()
+  prefix = ndb.StringProperty()
+
+  # The marker of the next listing page, or None to start from the top.
+  marker = ndb.StringProperty()
+  pages = ndb.IntegerProperty(default=0)
+  deleted = ndb.IntegerProperty(default=0)
+  failed = ndb.IntegerProperty(default=0)
+  done = ndb.BooleanProperty(default=False)
+
+  # A sample of object name -> delete error, and the last listing error.
+  errors = ndb.JsonProperty()
+  error = ndb.TextProperty()
+
+  @classmethod
+  def key_for(cls, job_id, prefix):
+    """Return the ndb.Key of the shard of a job and prefix."""
+    return ndb.Key(cls, '%d:%s' % (job_id, prefix))
 
 
 class GcsAppEngineHelper(object):
@@ -44,28 +138,203 @@ class GcsAppEngineHelper(object):
     self.credentials = credentials
     self.project_id = project_id
 
-  def delete_bucket_contents(self, bucket, directory=None, file_regex=None):
+  def delete_bucket_contents(self, user_id, bucket, directory=None,
+                             file_regex=None):
     """Deletes all the contents from a given bucket and directory path.
 
+    The cleanup runs in the background; its progress is returned by
+    get_cleanup_status. Only the objects under the literal prefix of
+    file_regex are listed, see cs.listing_filter.
+
     Args:
+      user_id: The string id of the user whose stored credentials are used.
       bucket: A string name of the Cloud Storage bucket.
       directory: A string name of the Cloud Storage 'directory'.
       file_regex: A regular expression to match against object names.
+
+    Returns:
+      The int id of the CleanupJob.
+    """
+    prefix, _ = cs.listing_filter(directory, file_regex)
+
+    @ndb.transactional(xg=True)
+    def start():
+      job = CleanupJob(
+          user_id=user_id, project_id=self.project_id, bucket=bucket,
+          directory=directory, file_regex=file_regex,
+          start_time=int(time.time()))
+      job.put()
+      if prefix is None:
+        # The regex can't match any object of the directory.
+        CleanupShard(key=CleanupShard.key_for(job.key.id(), ''),
+                     job_id=job.key.id(), prefix='', done=True).put()
+        return job.key.id()
+      CleanupShard(key=CleanupShard.key_for(job.key.id(), prefix),
+                   job_id=job.key.id(), prefix=prefix).put()
+      deferred.defer(cleanup_shard, job.key.id(), prefix,
+                     _transactional=True)
+      return job.key.id()
+
+    job_id = start()
+    logging.info('Started cleanup %d of %s/%s', job_id, bucket, prefix or '')
+    return job_id
+
+  def get_cleanup_status(self, job_id):
+    """Return the progress of a cleanup.
+
+    Args:
+      job_id: The int id of the CleanupJob.
+
+    Returns:
+      A dictionary with the progress of the cleanup, see CleanupJob.status,
+      or None if there is no such job.
     """
-    deferred.defer(cleanup_queue, self.credentials, self.project_id, bucket,
-                   directory, file_regex)
+    job = CleanupJob.get_by_id(job_id)
+    if not job:
+      return None
+    return job.status
+
 
+def cleanup_shard(job_id, prefix):
+  """Deferred task deleting one listing page of a cleanup shard.
 
-def cleanup_queue(credentials, project_id, bucket, directory, file_regex=None):
-  """Deletes all the contents from a given bucket and directory path.
+  The page is listed with CLEANUP_DELIMITER, so its common prefixes are
+  fanned out as new shards that run in parallel. The objects of the page
+  that match the job's file regex are deleted, then the next page marker is
+  checkpointed and the task for it is chained.
 
   Args:
-    credentials: An oauth2client.client.Credentials object.
-    project_id: A string name for the Cloud Storage project (this is a
-        string of numbers).
-    bucket: A string name of the Cloud Storage bucket.
-    directory: A string name of the Cloud Storage 'directory'.
-    file_regex: A regular expression to match against object names.
+    job_id: The int id of the CleanupJob.
+    prefix: The string prefix of the shard.
+
+  Raises:
+    CsError: Raised when the listing fails, so the task is retried.
+    PermanentTaskFailure: Raised when the user has no valid credentials,
+        after the shard is recorded as done with the error.
+  """
+  job = CleanupJob.get_by_id(job_id)
+  shard = CleanupShard.key_for(job_id, prefix).get()
+  if not job or not shard or shard.done:
+    return
+
+  oauth_token = _access_token(job.user_id)
+  if not oauth_token:
+    message = 'No valid credentials for user %s.' % job.user_id
+    _record_error(shard.key, message, done=True)
+    raise deferred.PermanentTaskFailure(message)
+  gcs = cs.Cs(job.project_id)
+  try:
+    listing = gcs.list_page(oauth_token, job.bucket, prefix or None,
+                            shard.marker, CLEANUP_DELIMITER)
+  except cs.CsError, e:
+    _record_error(shard.key, str(e))
+    raise
+
+  _fan_out(job_id, listing.prefixes)
+
+  _, pattern = cs.listing_filter(job.directory, job.file_regex)
+  names = [cs_object.name for cs_object in listing.objects
+           if not pattern or pattern.match(cs_object.name)]
+  errors = {}
+  if names:
+    errors = gcs.delete_objects(oauth_token, job.bucket, names)
+  for object_name, message in sorted(errors.items()):
+    logging.error('Error deleting %s/%s: %s', job.bucket, object_name, message)
+
+  @ndb.transactional
+  def checkpoint():
+    current = shard.key.get()
+    if current.marker != shard.marker or current.done:
+      # Another run of this task already recorded the page.
+      return
+    current.marker = listing.next_marker
+    current.pages += 1
+    current.deleted += len(names) - len(errors)
+    current.failed += len(errors)
+    current.done = listing.next_marker is None
+    current.error = None
+    sample = current.errors or {}
+    for object_name in sorted(errors)[:CLEANUP_ERROR_SAMPLE - len(sample)]:
+      sample[object_name] = errors[object_name]
+    current.errors = sample
+    current.put()
+    if not current.done:
+      deferred.defer(cleanup_shard, job_id, prefix, _transactional=True)
+
+  checkpoint()
+
+
+def _fan_out(job_id, prefixes):
+  """Creates the shards of the given prefixes and starts their tasks.
+
+  The first task of a shard is named after the job and prefix, and is
+  enqueued on every attempt for each shard not done yet, so a retried page
+  starts the shards whose tasks a failed attempt didn't enqueue, but never
+  starts a prefix twice.
+
+  Args:
+    job_id: The int id of the CleanupJob.
+    prefixes: A list of the string prefixes to shard.
+  """
+  if not prefixes:
+    return
+  keys = [CleanupShard.key_for(job_id, prefix) for prefix in prefixes]
+  shards = ndb.get_multi(keys)
+  new_shards = [CleanupShard(key=key, job_id=job_id, prefix=prefix)
+                for key, prefix, shard in zip(keys, prefixes, shards)
+                if shard is None]
+  ndb.put_multi(new_shards)
+  for key, prefix, shard in zip(keys, prefixes, shards):
+    if shard and shard.done:
+      continue
+    task_name = 'cleanup-%s' % hashlib.sha1(
+        key.id().encode('utf-8')).hexdigest()
+    try:
+      deferred.defer(cleanup_shard, job_id, prefix, _name=task_name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass
+
+
+def _record_error(shard_key, message, done=False):
+  """Records the last listing error of a shard for its progress.
+
+  Args:
+    shard_key: The ndb.Key of the CleanupShard.
+    message: The string error message.
+    done: True if the shard is given up on.
+  """
+  logging.error('Error cleaning up %s: %s', shard_key.id(), message)
+  shard = shard_key.get()
+  shard.error = message
+  if done:
+    shard.done = True
+  shard.put()
+
+
+def _access_token(user_id):
+  """Return a valid access token from the user's stored credentials.
+
+  Expired credentials are refreshed, and the new token is stored.
+
+  Args:
+    user_id: The string id of the user.
+
+  Returns:
+    The string access token, or None if the user has no valid credentials.
+
+  Raises:
+    AccessTokenRefreshError: Raised when the refresh fails but the
+        credentials are still valid, so it may be retried.
   """
-  cs.Cs(project_id).delete_bucket_contents(
-      credentials.access_token, bucket, directory, file_regex)
+  credentials = oauth2client.StorageByKeyName(
+      oauth2client.CredentialsModel, user_id, 'credentials').get()
+  if not credentials or credentials.invalid:
+    return None
+  if credentials.access_token_expired:
+    try:
+      credentials.refresh(httplib2.Http())
+    except client.AccessTokenRefreshError:
+      if credentials.invalid:
+        return None
+      raise
+  return credentials.access_token
@@ -19,12 +19,15 @@ __author__ = 'kbrisbin@google.com (Kathryn Hurley)'
 import json
 import logging
 import threading
+import time
 
 import jinja2
 import webapp2
 
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 
 jinja_environment = jinja2.Environment(loader=jinja2.FileSystemLoader(''))
 
@@ -75,6 +78,17 @@ DEFAULTS = {
 }
 
 URL_PATH = '/%s/project'
+# Seconds user data stays in memcache, and the memcache key of a user.
+MEMCACHE_TTL = 3600
+MEMCACHE_KEY = 'user-data:%s'
+# The memcache key of the generation of a user's data, bumped on each write.
+GENERATION_KEY = 'user-data-generation:%s'
+# The number of entities each migrate_user_data task moves.
+MIGRATE_BATCH_SIZE = 100
+
+# user_id -> (generation, JSON string) of the user data read by this
+# instance.
+_local_cache = {}
 
 
 class JsonProperty(db.Property):
@@ -147,11 +161,146 @@ class JsonProperty(db.Property):
 
 
 class UserData(db.Model):
-  """Store the user data."""
+  """Store the user data.
+
+  Entities are keyed by the user's user_id. Entities written before that
+  have generated keys; they are moved to keyed entities when read, or in
+  bulk by migrate_user_data.
+  """
   user = db.UserProperty(required=True)
   user_data = JsonProperty()
 
 
+def get_user_data(user):
+  """Return the stored data of a user.
+
+  The data is read through a per-instance cache and memcache, so most
+  requests don't touch the datastore. The per-instance copy is only used
+  while its generation is current in memcache, so writes made through other
+  instances are seen at once.
+
+  Args:
+    user: A users.User object.
+
+  Returns:
+    A new dictionary of the user's data, or None if there is none.
+  """
+  user_id = user.user_id()
+  generation = _get_generation(user_id)
+  cached = _local_cache.get(user_id)
+  if cached and generation is not None and cached[0] == generation:
+    return json.loads(cached[1])
+
+  value = memcache.get(MEMCACHE_KEY % user_id)
+  if value is None:
+    entity = _get_entity(user)
+    if not entity:
+      return None
+    value = json.dumps(entity.user_data)
+    # add rather than set, so a concurrent write isn't overwritten with the
+    # data read before it.
+    memcache.add(MEMCACHE_KEY % user_id, value, time=MEMCACHE_TTL)
+  _local_cache[user_id] = (generation, value)
+  return json.loads(value)
+
+
+def put_user_data(user, data):
+  """Stores the data of a user and updates the caches.
+
+  Args:
+    user: A users.User object.
+    data: A dictionary of the user's data.
+  """
+  user_id = user.user_id()
+  UserData(key_name=user_id, user=user, user_data=data).put()
+  value = json.dumps(data)
+  memcache.set(MEMCACHE_KEY % user_id, value, time=MEMCACHE_TTL)
+  # Bumped after the data is set, so instances seeing the new generation
+  # read the new data.
+  memcache.incr(GENERATION_KEY % user_id, initial_value=_new_generation())
+  _local_cache.pop(user_id, None)
+
+
+def migrate_user_data(cursor=None):
+  """Deferred task moving UserData entities to keys named by user_id.
+
+  Each task moves up to MIGRATE_BATCH_SIZE entities and chains the next
+  one, so it can be started once from the remote API shell or a task with
+  deferred.defer(user_data.migrate_user_data).
+
+  Args:
+    cursor: The string query cursor to continue from, if any.
+  """
+  query = UserData.all()
+  if cursor:
+    query.with_cursor(cursor)
+  entities = query.fetch(MIGRATE_BATCH_SIZE)
+  migrated = [e for e in entities if _migrate(e) is not e]
+  logging.info('Migrated %d of %d UserData entities',
+               len(migrated), len(entities))
+  if len(entities) == MIGRATE_BATCH_SIZE:
+    deferred.defer(migrate_user_data, query.cursor())
+
+
+def _get_generation(user_id):
+  """Return the current generation of a user's data, starting one if needed.
+
+  A generation evicted from memcache is restarted from the clock rather than
+  from zero, so it doesn't match copies cached before the eviction.
+  """
+  key = GENERATION_KEY % user_id
+  generation = memcache.get(key)
+  if generation is None:
+    memcache.add(key, _new_generation())
+    generation = memcache.get(key)
+  return generation
+
+
+def _new_generation():
+  """Return a generation number unlikely to have been used before."""
+  return int(time.time() * 1000000)
+
+
+def _get_entity(user):
+  """Return the UserData entity of a user from the datastore, or None.
+
+  An entity with a generated key is moved to the user_id key first.
+  """
+  entity = UserData.get_by_key_name(user.user_id())
+  if not entity:
+    entity = _migrate(UserData.all().filter('user =', user).get())
+  return entity
+
+
+def _migrate(entity):
+  """Moves a UserData entity to the key named by its user_id.
+
+  Args:
+    entity: A UserData entity, or None.
+
+  Returns:
+    The keyed entity, or None if entity is None.
+  """
+  if not entity:
+    return None
+  user_id = entity.user.user_id()
+  if entity.key().name() == user_id:
+    return entity
+
+  def move():
+    # The keyed entity wins if a write already created it.
+    keyed = UserData.get_by_key_name(user_id)
+    if not keyed:
+      keyed = UserData(key_name=user_id, user=entity.user,
+                       user_data=entity.user_data)
+      keyed.put()
+    return keyed
+
+  keyed = db.run_in_transaction(move)
+  entity.delete()
+  return keyed
+
+
 class DataHandler(object):
   """Store user data in database."""
 
@@ -231,13 +380,13 @@ class DataHandler(object):
         return webapp2.redirect(
             users.create_login_url(request_handler.request.uri))
 
-      user_data = UserData.all().filter('user =', user).get()
+      user_data = get_user_data(user)
       if user_data:
-        self.stored_user_data = user_data.user_data
+        self.stored_user_data = user_data
 
       for parameter in self._parameters:
         if parameter['required']:
-          if not (user_data and user_data.user_data.get(parameter['name'])):
+          if not (user_data and user_data.get(parameter['name'])):
             return webapp2.redirect(self.url_path)
 
       try:
@@ -290,12 +439,12 @@ class DataHandler(object):
       The modified webapp2.Response object.
     """
 
-    user_data = UserData.all().filter('user =', user).get()
+    user_data = get_user_data(user)
 
     variables = {'demo_name': self._demo_name}
     variables['user_entered'] = {}
     if user_data:
-      data = user_data.user_data
+      data = user_data
       # Convert 'list' typed user-data to a comma separated string
       # for easier user editing e.g. a,b vs. ['a', 'b'].
       for parameter in self._parameters:
@@ -304,7 +453,7 @@ class DataHandler(object):
           if name in data:
             data[name] = ','.join(data[name])
       # Copy all saved values into the output.
-      for name in user_data.user_data:
+      for name in user_data:
         variables['user_entered'][name] = data[name]
 
     variables['parameters'] = self._parameters
@@ -324,7 +473,9 @@ class DataHandler(object):
       A redirect to the redirect URI.
     """
 
-    user_data = UserData.all().filter('user =', user).get()
+    # Read the entity rather than the caches, so the data is merged with the
+    # latest write.
+    user_data = _get_entity(user)
     new_user_data = {}
     if user_data:
       new_user_data = user_data.user_data
@@ -338,11 +489,6 @@ class DataHandler(object):
         entered_value = [v.strip() for v in entered_value.split(',')]
       new_user_data[data['name']] = entered_value
 
-    if user_data:
-      user_data.user_data = new_user_data
-      user_data.save()
-    else:
-      user_data = UserData(user=user, user_data=new_user_data)
-      user_data.put()
+    put_user_data(user, new_user_data)
 
     return webapp2.redirect(self._redirect_uri)